@@ -49,25 +49,23 @@ class ImageGenAsync:
         return self
 
     async def __aexit__(self, *excinfo) -> None:
-        await self.session.close()
+        await self.close()
 
-    def __del__(self):
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        loop.run_until_complete(self._close())
-
-    async def _close(self):
-        await self.session.close()
+    async def close(self) -> None:
+        """
+        Closes http session, must be called inside the running event loop
+        """
+        if not self.session.closed:
+            await self.session.close()
 
-    async def get_images(self, prompt: str) -> list:
+    async def get_images(self, prompt: str, timeout: float = 300) -> list:
         """
         Fetches image links from Bing
         Parameters:
             prompt: str
+            timeout: float, seconds before giving up polling
         """
+        deadline = asyncio.get_running_loop().time() + timeout
         if not self.quiet:
             print("Sending request...")
         url_encoded_prompt = requests.utils.quote(prompt)
@@ -105,11 +103,12 @@ class ImageGenAsync:
         while True:
             if not self.quiet:
                 print(".", end="", flush=True)
-            # By default, timeout is 300s, change as needed
-            response = await self.session.get(polling_url)
-            if response.status != 200:
-                raise Exception("Could not get results")
-            content = await response.text()
+            if asyncio.get_running_loop().time() > deadline:
+                raise Exception("Image generation timed out")
+            async with self.session.get(polling_url) as response:
+                if response.status != 200:
+                    raise Exception("Could not get results")
+                content = await response.text()
             if content and content.find("errorMessage") == -1:
                 break
 
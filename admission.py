@@ -0,0 +1,75 @@
+import time
+from log import getlogger
+
+logger = getlogger()
+
+
+class AdmissionController:
+    """
+    Load shedding based on predicted completion time
+    Parameters:
+        slo: float, seconds a request is allowed to take
+        alpha: float, weight of the newest sample in moving averages
+        half_life: float, seconds after which an old average counts half,
+            so a command shed after a slow spell is admitted again
+    """
+
+    def __init__(
+        self, slo: float = 120, alpha: float = 0.2, half_life: float = 60
+    ) -> None:
+        self.slo = slo
+        self.alpha = alpha
+        self.half_life = half_life
+        # command -> slo overriding the default one
+        self.command_slo: dict[str, float] = {}
+        # command -> (moving average of service time, updated at)
+        self.latency: dict[str, tuple[float, float]] = {}
+        # moving average of queue wait time, updated at
+        self.wait = (0.0, time.monotonic())
+
+    def _decayed(self, average: tuple[float, float]) -> float:
+        value, updated_at = average
+        return value * 0.5 ** ((time.monotonic() - updated_at) / self.half_life)
+
+    def _average(self, old: tuple[float, float], sample: float) -> tuple:
+        value = (1 - self.alpha) * self._decayed(old) + self.alpha * sample
+        return (value, time.monotonic())
+
+    # timed out and failed requests are recorded too
+    def record_latency(self, command: str, seconds: float) -> None:
+        if command in self.latency:
+            self.latency[command] = self._average(self.latency[command], seconds)
+        else:
+            self.latency[command] = (seconds, time.monotonic())
+
+    def record_wait(self, seconds: float) -> None:
+        self.wait = self._average(self.wait, seconds)
+
+    # predicted seconds until a new request of command is answered
+    def predict(
+        self, command: str, pending: int, running: int, concurrency: int
+    ) -> float:
+        latency = {name: self._decayed(value) for name, value in self.latency.items()}
+        if latency:
+            mean_latency = sum(latency.values()) / len(latency)
+        else:
+            mean_latency = 0.0
+        # jobs ahead are served by all workers in parallel
+        queue_wait = 0.0
+        ahead = pending + running - max(concurrency, 1) + 1
+        if ahead > 0:
+            queue_wait = max(
+                self._decayed(self.wait), ahead * mean_latency / max(concurrency, 1)
+            )
+        return queue_wait + latency.get(command, 0.0)
+
+    def admit(self, command: str, pending: int, running: int, concurrency: int) -> bool:
+        predicted = self.predict(command, pending, running, concurrency)
+        slo = self.command_slo.get(command, self.slo)
+        if predicted > slo:
+            logger.warning(
+                f"shedding {command} request, predicted {predicted:.1f}s "
+                + f"exceeds {slo}s"
+            )
+            return False
+        return True
@@ -1,7 +1,11 @@
 import aiohttp
-import asyncio
 import json
+import time
+from typing import Union
 
+from config import parse_list
+from endpoints import EndpointPool, status_error
+from keypool import KeyPool
 from log import getlogger
 
 logger = getlogger()
@@ -9,13 +13,18 @@ logger = getlogger()
 
 class askGPT:
     def __init__(
-        self, session: aiohttp.ClientSession, api_endpoint: str, headers: str
+        self,
+        session: aiohttp.ClientSession,
+        api_endpoint: Union[str, list],
+        key_pool: KeyPool,
     ) -> None:
         self.session = session
-        self.api_endpoint = api_endpoint
-        self.headers = headers
+        self.endpoints = EndpointPool(
+            parse_list(api_endpoint) or ["https://api.openai.com/v1/chat/completions"]
+        )
+        self.key_pool = key_pool
 
-    async def oneTimeAsk(self, prompt: str) -> str:
+    async def oneTimeAsk(self, prompt: str, timeout: float = 120) -> str:
         jsons = {
             "model": "gpt-3.5-turbo",
             "messages": [
@@ -25,22 +34,29 @@ class askGPT:
                 },
             ],
         }
-        max_try = 2
-        while max_try > 0:
-            try:
-                async with self.session.post(
-                    url=self.api_endpoint, json=jsons, headers=self.headers, timeout=120
-                ) as response:
-                    status_code = response.status
-                    if not status_code == 200:
-                        # print failed reason
-                        logger.warning(str(response.reason))
-                        max_try = max_try - 1
-                        # wait 2s
-                        await asyncio.sleep(2)
-                        continue
-
-                    resp = await response.read()
-                    return json.loads(resp)["choices"][0]["message"]["content"]
-            except Exception as e:
-                raise Exception(e)
+        # timeout covers all attempts
+        deadline = time.monotonic() + timeout
+
+        async def attempt(endpoint: str) -> str:
+            # least loaded api key
+            async with self.key_pool.acquire() as api_key, self.session.post(
+                url=endpoint,
+                json=jsons,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {api_key.key}",
+                },
+                timeout=max(deadline - time.monotonic(), 0.001),
+            ) as response:
+                status_code = response.status
+                self.key_pool.update(api_key, status_code, response.headers)
+                if not status_code == 200:
+                    # print failed reason
+                    logger.warning(str(response.reason))
+                    raise status_error(status_code, response.reason)
+
+                resp = await response.read()
+                return json.loads(resp)["choices"][0]["message"]["content"]
+
+        # hedged request with failover across endpoints
+        return await self.endpoints.request(attempt)
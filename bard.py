@@ -53,10 +53,11 @@ class Bardbot:
         SNlM0e = re.search(r"SNlM0e\":\"(.*?)\"", resp.text).group(1)
         return SNlM0e
 
-    def ask(self, message: str) -> dict:
+    def ask(self, message: str, timeout: float = 120) -> dict:
         """
         Send a message to Google Bard and return the response.
         :param message: The message to send to Google Bard.
+        :param timeout: Seconds to wait for Google Bard.
         :return: A dict containing the response from Google Bard.
         """
         # url params
@@ -82,7 +83,7 @@ class Bardbot:
             "https://bard.google.com/_/BardChatUi/data/assistant.lamda.BardFrontendService/StreamGenerate",
             params=params,
             data=data,
-            timeout=120,
+            timeout=timeout,
         )
 
         chat_data = json.loads(resp.content.splitlines()[3])[0][2]
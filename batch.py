@@ -0,0 +1,331 @@
+"""
+Run prompts from a JSONL file through the bot's backends
+
+    python batch.py prompts.jsonl results.jsonl --backend gpt --concurrency 4
+
+Each input line is {"prompt": str, "id": optional, "backend": optional,
+"conversation": optional}. Results are appended to the output file as they
+finish, prompts already answered there are skipped on restart and their
+chat and bing turns are replayed into the conversation.
+With --warm-cache answers are stored in the bot's similarity and image
+caches, run it before the bot starts so they are loaded.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import time
+from typing import Optional
+import aiohttp
+from askgpt import askGPT
+from v3 import Chatbot
+from bing import BingBot
+from BingImageGen import ImageGenAsync
+from config import load_config, parse_list
+from deadline import remaining, set_deadline
+from imagecache import ImageCache
+from keypool import KeyPool
+from simcache import SimilarityCache
+from state import StateStore
+from log import getlogger
+
+logger = getlogger()
+
+BACKENDS = ("gpt", "chat", "bing", "pic")
+
+
+class RateLimiter:
+    """
+    Space out request starts
+    Parameters:
+        rate: float, requests per second, None is unlimited
+    """
+
+    def __init__(self, rate: Optional[float] = None) -> None:
+        self.interval = 1 / rate if rate else 0.0
+        self.next_at = 0.0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        if not self.interval:
+            return
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_at > now:
+                await asyncio.sleep(self.next_at - now)
+            self.next_at = max(now, self.next_at) + self.interval
+
+
+class BatchRunner:
+    """
+    Run prompts concurrently and stream results to a JSONL file
+    Parameters:
+        config: dict, same keys as config.json
+        output_path: str, results are appended here
+        backend: str, default backend of prompts without one
+        concurrency: int, prompts in flight
+        rate: float, requests per second per backend, None is unlimited
+        timeout: float, seconds a single prompt is allowed to take
+        warm_cache: bool, store answers in the bot's response caches
+    """
+
+    def __init__(
+        self,
+        config: dict,
+        output_path: str,
+        backend: str = "gpt",
+        concurrency: int = 4,
+        rate: Optional[float] = None,
+        timeout: float = 120,
+        warm_cache: bool = False,
+    ) -> None:
+        self.config = config
+        self.output_path = output_path
+        self.backend = backend
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.warm_cache = warm_cache
+        self.limiters = {name: RateLimiter(rate) for name in BACKENDS}
+        # turns of one conversation run in order
+        self.conversation_locks: dict[tuple, asyncio.Lock] = {}
+        # conversation -> bing state, prompts without one start a new chat
+        self.bing_states: dict[str, dict] = {}
+        self.session = aiohttp.ClientSession()
+        self.output = None
+
+        openai_api_key = config.get("openai_api_key")
+        if openai_api_key is not None:
+            key_pool = KeyPool(
+                parse_list(openai_api_key),
+                max_concurrency=int(config.get("openai_key_concurrency") or 8),
+            )
+            endpoint = (
+                config.get("openai_api_endpoint")
+                or "https://api.openai.com/v1/chat/completions"
+            )
+            self.askgpt = askGPT(self.session, endpoint, key_pool)
+            self.chatbot = Chatbot(
+                api_key=key_pool.keys[0].key,
+                api_url=config.get("openai_api_endpoint"),
+                key_pool=key_pool,
+                engines=config.get("openai_engines"),
+            )
+        self.bing_api_endpoint = config.get("bing_api_endpoint")
+        if config.get("bing_auth_cookie") is not None:
+            self.imagegen = ImageGenAsync(auth_cookie=config["bing_auth_cookie"])
+
+        # response caches shared with the bot
+        self.caches: dict[str, SimilarityCache] = {}
+        self.similarity_store: Optional[StateStore] = None
+        self.image_cache: Optional[ImageCache] = None
+        if warm_cache:
+            path = config.get("similarity_cache_path")
+            if path:
+                threshold = float(config.get("similarity_threshold") or 0.8)
+                max_size = int(config.get("similarity_cache_size") or 1000)
+                self.similarity_store = StateStore(path)
+                entries = self.similarity_store.load()
+                for name in ("gpt", "bing"):
+                    self.caches[name] = SimilarityCache(threshold, max_size, name=name)
+                    self.caches[name].load(entries.get(name, []))
+            else:
+                logger.warning(
+                    "similarity_cache_path is not provided, "
+                    + "!gpt and !bing answers will not be cached"
+                )
+            self.image_cache = ImageCache(
+                path=config.get("image_cache_path") or "images/cache",
+                max_size=int(config.get("image_cache_size") or 512) << 20,
+            )
+
+    # results answered by a previous run by id, failed prompts are retried
+    def finished_results(self) -> dict:
+        finished = {}
+        if not os.path.exists(self.output_path):
+            return finished
+        with open(self.output_path, "r", encoding="utf-8") as fp:
+            for line in fp:
+                try:
+                    result = json.loads(line)
+                except ValueError:
+                    # last line may be cut by a crash
+                    continue
+                if "error" not in result:
+                    finished[result["id"]] = result
+        return finished
+
+    # restore conversation of a turn answered by a previous run
+    def replay(self, item: dict, result: dict) -> None:
+        convo_id = item.get("conversation") or item["id"]
+        if item["backend"] == "chat" and hasattr(self, "chatbot"):
+            if convo_id not in self.chatbot.conversation:
+                self.chatbot.reset(convo_id)
+            self.chatbot.add_to_conversation(item["prompt"], "user", convo_id)
+            self.chatbot.add_to_conversation(result["response"], "assistant", convo_id)
+        if item["backend"] == "bing" and "bing_state" in result:
+            self.bing_states[convo_id] = result["bing_state"]
+
+    def read_prompts(self, input_path: str) -> list:
+        finished = self.finished_results()
+        items = []
+        with open(input_path, "r", encoding="utf-8") as fp:
+            for index, line in enumerate(fp):
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                item.setdefault("id", str(index))
+                item.setdefault("backend", self.backend)
+                if item["backend"] not in BACKENDS:
+                    raise ValueError(f"unknown backend {item['backend']}")
+                if item["id"] in finished:
+                    self.replay(item, finished[item["id"]])
+                else:
+                    items.append(item)
+        if finished:
+            logger.info(f"resuming, {len(finished)} prompt(s) already answered")
+        return items
+
+    async def ask(self, item: dict) -> dict:
+        backend = item["backend"]
+        prompt = item["prompt"]
+        if backend in ("gpt", "chat") and not hasattr(self, "askgpt"):
+            raise Exception("openai_api_key is not provided")
+        if backend == "bing" and self.bing_api_endpoint is None:
+            raise Exception("bing_api_endpoint is not provided")
+        if backend == "pic" and not hasattr(self, "imagegen"):
+            raise Exception("bing_auth_cookie is not provided")
+
+        await self.limiters[backend].acquire()
+        # backends get what is left of the deadline set in run_one
+        if backend == "gpt":
+            response = await self.askgpt.oneTimeAsk(
+                prompt, timeout=remaining(self.timeout)
+            )
+            return {"response": response}
+        convo_id = item.get("conversation") or item["id"]
+        if backend in ("chat", "bing"):
+            lock = self.conversation_locks.setdefault(
+                (backend, convo_id), asyncio.Lock()
+            )
+            async with lock:
+                if backend == "chat":
+                    response = await self.chatbot.ask_async(
+                        prompt, convo_id=convo_id, timeout=remaining(self.timeout)
+                    )
+                    return {"response": response}
+                return await self.ask_bing(prompt, convo_id)
+
+        links = await self.imagegen.get_images(prompt, timeout=remaining(self.timeout))
+        image_path = await self.imagegen.save_images(links, "images")
+        if self.image_cache is not None:
+            image_path = self.image_cache.add_blob(prompt, image_path)
+        return {"image": image_path}
+
+    # bingbot keeps its conversation in data, so each conversation gets its own
+    async def ask_bing(self, prompt: str, convo_id: str) -> dict:
+        bingbot = BingBot(
+            session=self.session, bing_api_endpoint=self.bing_api_endpoint
+        )
+        bingbot.data.update(self.bing_states.get(convo_id, {}))
+        response = await bingbot.ask_bing(prompt, timeout=remaining(self.timeout))
+        if response == "Error, please retry":
+            raise Exception(response)
+        state = {key: value for key, value in bingbot.data.items() if key != "message"}
+        self.bing_states[convo_id] = state
+        return {"response": response, "bing_state": state}
+
+    async def run_one(self, item: dict) -> None:
+        result = {
+            "id": item["id"],
+            "backend": item["backend"],
+            "prompt": item["prompt"],
+        }
+        start = time.monotonic()
+        # deadline is inherited by backend requests
+        set_deadline(self.timeout)
+        try:
+            result.update(await asyncio.wait_for(self.ask(item), self.timeout))
+            cache = self.caches.get(item["backend"])
+            if cache is not None:
+                cache.put(item["prompt"], result["response"])
+        except Exception as e:
+            logger.warning(f"prompt {item['id']} failed: {e}")
+            result["error"] = str(e) or type(e).__name__
+        result["latency"] = round(time.monotonic() - start, 3)
+        # one line per result so an interrupted run can resume
+        self.output.write(json.dumps(result, ensure_ascii=False) + "\n")
+        self.output.flush()
+
+    async def worker(self, queue: asyncio.Queue) -> None:
+        while True:
+            item = await queue.get()
+            try:
+                await self.run_one(item)
+            finally:
+                queue.task_done()
+
+    async def run(self, input_path: str) -> None:
+        items = self.read_prompts(input_path)
+        logger.info(f"running {len(items)} prompt(s)")
+        queue: asyncio.Queue = asyncio.Queue()
+        for item in items:
+            queue.put_nowait(item)
+        self.output = open(self.output_path, "a", encoding="utf-8")
+        workers = [
+            asyncio.create_task(self.worker(queue)) for _ in range(self.concurrency)
+        ]
+        try:
+            await queue.join()
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self.output.close()
+            if self.similarity_store is not None:
+                self.similarity_store.save(
+                    {name: cache.dump() for name, cache in self.caches.items()}
+                )
+
+    async def close(self) -> None:
+        if hasattr(self, "chatbot"):
+            await self.chatbot.close()
+        if hasattr(self, "imagegen"):
+            await self.imagegen.close()
+        await self.session.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run prompts from a JSONL file")
+    parser.add_argument("input", help="JSONL file of prompts")
+    parser.add_argument("output", help="JSONL file results are appended to")
+    parser.add_argument("--backend", choices=BACKENDS, default="gpt")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument(
+        "--rate", type=float, default=None, help="requests per second per backend"
+    )
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument(
+        "--warm-cache",
+        action="store_true",
+        help="store answers in the bot's similarity and image caches",
+    )
+    parser.add_argument("--config", default="config.json")
+    args = parser.parse_args()
+
+    runner = BatchRunner(
+        load_config(args.config),
+        args.output,
+        backend=args.backend,
+        concurrency=args.concurrency,
+        rate=args.rate,
+        timeout=args.timeout,
+        warm_cache=args.warm_cache,
+    )
+    try:
+        await runner.run(args.input)
+    finally:
+        await runner.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
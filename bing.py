@@ -1,6 +1,7 @@
 import aiohttp
 import json
 import asyncio
+import time
 from log import getlogger
 
 # api_endpoint = "http://localhost:3000/conversation"
@@ -28,16 +29,21 @@ class BingBot:
         if self.jailbreakEnabled:
             self.data["jailbreakConversationId"] = True
 
-    async def ask_bing(self, prompt) -> str:
+    async def ask_bing(self, prompt, timeout: float = 120) -> str:
         self.data["message"] = prompt
         max_try = 2
+        # timeout covers all retries
+        deadline = time.monotonic() + timeout
         while max_try > 0:
             try:
-                resp = await self.session.post(
-                    url=self.bing_api_endpoint, json=self.data, timeout=120
-                )
-                status_code = resp.status
-                body = await resp.read()
+                # release connection when cancelled
+                async with self.session.post(
+                    url=self.bing_api_endpoint,
+                    json=self.data,
+                    timeout=max(deadline - time.monotonic(), 0.001),
+                ) as resp:
+                    status_code = resp.status
+                    body = await resp.read()
                 if not status_code == 200:
                     # print failed reason
                     logger.warning(str(resp.reason))
@@ -58,6 +64,9 @@ class BingBot:
                     self.data["clientId"] = json_body["clientId"]
                     self.data["invocationId"] = json_body["invocationId"]
                 return json_body["details"]["adaptiveCards"][0]["body"][0]["text"]
+            except asyncio.TimeoutError:
+                logger.warning("bing request timed out")
+                break
             except Exception as e:
                 logger.error("Error Exception", exc_info=True)
 
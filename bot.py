@@ -1,20 +1,63 @@
 from mattermostdriver import Driver
-from typing import Optional
+from typing import Optional, Union
 import json
 import asyncio
+import functools
 import re
 import os
+import time
 import aiohttp
 from askgpt import askGPT
 from v3 import Chatbot
 from bing import BingBot
 from bard import Bardbot
 from BingImageGen import ImageGenAsync
+from metadata import MetadataIndex
+from scheduler import FairScheduler, UserBudget
+from poster import Poster
+from state import StateStore
+from simcache import SimilarityCache
+from imagecache import ImageCache
+from breaker import CircuitBreaker
+from deadline import current_deadline, remaining, set_deadline
+from admission import AdmissionController
+from keypool import KeyPool
+from config import parse_list
+from shard import ShardRouter
 from log import getlogger
 
 logger = getlogger()
 
 
+# mattermost driver authenticated with token or password
+def create_driver(
+    server_url: str,
+    access_token: Optional[str] = None,
+    login_id: Optional[str] = None,
+    password: Optional[str] = None,
+    port: Optional[int] = None,
+    timeout: Optional[int] = None,
+) -> Driver:
+    if server_url is None:
+        raise ValueError("server url must be provided")
+
+    # login relative info
+    if access_token is None and password is None:
+        raise ValueError("Either token or password must be provided")
+
+    options = {
+        "url": server_url,
+        "port": int(port or 443),
+        "request_timeout": int(timeout or 30),
+    }
+    if access_token is not None:
+        options["token"] = access_token
+    else:
+        options["login_id"] = login_id
+        options["password"] = password
+    return Driver(options)
+
+
 class Bot:
     def __init__(
         self,
@@ -23,46 +66,51 @@ class Bot:
         access_token: Optional[str] = None,
         login_id: Optional[str] = None,
         password: Optional[str] = None,
-        openai_api_key: Optional[str] = None,
-        openai_api_endpoint: Optional[str] = None,
+        openai_api_key: Optional[Union[str, list]] = None,
+        openai_api_endpoint: Optional[Union[str, list]] = None,
         bing_api_endpoint: Optional[str] = None,
         bard_token: Optional[str] = None,
         bing_auth_cookie: Optional[str] = None,
         port: int = 443,
         timeout: int = 30,
+        metadata_ttl: int = 600,
+        concurrency: int = 4,
+        user_max_requests: Optional[int] = None,
+        user_max_tokens: Optional[int] = None,
+        budget_window: int = 3600,
+        max_post_size: int = 16383,
+        state_path: str = "state.json",
+        shutdown_timeout: int = 30,
+        similarity_cache: bool = False,
+        similarity_threshold: float = 0.8,
+        similarity_cache_size: int = 1000,
+        image_cache: bool = False,
+        image_cache_path: str = "images/cache",
+        image_cache_size: int = 512,
+        breaker_error_rate: float = 0.5,
+        breaker_slow_call: float = 60,
+        breaker_image_slow_call: float = 300,
+        breaker_open_timeout: float = 30,
+        request_timeout: float = 120,
+        image_request_timeout: float = 360,
+        admission_slo: Optional[float] = None,
+        openai_key_concurrency: int = 8,
+        replica_index: int = 0,
+        replica_count: int = 1,
+        shard_dir: Optional[str] = None,
+        compact_threshold: Optional[int] = None,
+        compact_target: Optional[int] = None,
+        openai_engines: Optional[Union[str, list]] = None,
+        similarity_cache_path: Optional[str] = None,
     ) -> None:
-        if server_url is None:
-            raise ValueError("server url must be provided")
+        # keep initial config to find changed keys on reload
+        self.config = {
+            key: value for key, value in locals().items() if key != "self"
+        }
 
-        if port is None:
-            self.port = 443
-
-        if timeout is None:
-            self.timeout = 30
-
-        # login relative info
-        if access_token is None and password is None:
-            raise ValueError("Either token or password must be provided")
-
-        if access_token is not None:
-            self.driver = Driver(
-                {
-                    "token": access_token,
-                    "url": server_url,
-                    "port": self.port,
-                    "request_timeout": self.timeout,
-                }
-            )
-        else:
-            self.driver = Driver(
-                {
-                    "login_id": login_id,
-                    "password": password,
-                    "url": server_url,
-                    "port": self.port,
-                    "request_timeout": self.timeout,
-                }
-            )
+        self.driver = create_driver(
+            server_url, access_token, login_id, password, port, timeout
+        )
 
         # @chatgpt
         if username is None:
@@ -70,38 +118,159 @@ class Bot:
         else:
             self.username = username
 
+        # cached user/channel metadata
+        if metadata_ttl is None:
+            metadata_ttl = 600
+        self.metadata = MetadataIndex(self.driver, ttl=int(metadata_ttl))
+
+        # handle only channels of this replica's shard
+        self.shard = ShardRouter(
+            replica_index=int(replica_index or 0),
+            replica_count=int(replica_count or 1),
+            shard_dir=shard_dir,
+        )
+
+        # rate limited outbound posting
+        if max_post_size is None:
+            max_post_size = 16383
+        self.poster = Poster(self.driver, max_post_size=int(max_post_size))
+
+        # graceful shutdown and conversation state handoff
+        if state_path is None:
+            state_path = "state.json"
+        self.state_store = StateStore(state_path)
+        if shutdown_timeout is None:
+            shutdown_timeout = 30
+        self.shutdown_timeout = int(shutdown_timeout)
+        self.accepting = True
+        # tasks running outside scheduler
+        self.tasks: set[asyncio.Task] = set()
+
+        # end-to-end deadline and cancellation of requests
+        # post_id -> (channel_id, user_id, task), task is None while queued
+        self.requests: dict[str, tuple] = {}
+        # queued post ids cancelled before start
+        self.cancelled: set[str] = set()
+
+        # shed load when predicted completion exceeds slo
+        self.admission = AdmissionController()
+        self.configure_deadlines(request_timeout, image_request_timeout, admission_slo)
+        # close functions of clients replaced by config reload
+        self.retired: list = []
+        self.retire_tasks: set[asyncio.Task] = set()
+
+        # per-user fair scheduling and budgets
+        if concurrency is None:
+            concurrency = 4
+        self.scheduler = FairScheduler(concurrency=int(concurrency))
+        if budget_window is None:
+            budget_window = 3600
+        self.budget = UserBudget(
+            max_requests=int(user_max_requests) if user_max_requests else None,
+            max_tokens=int(user_max_tokens) if user_max_tokens else None,
+            window=int(budget_window),
+        )
+
+        # near-duplicate prompt cache for !gpt and !bing
+        self.init_similarity_cache(
+            similarity_cache,
+            similarity_threshold,
+            similarity_cache_size,
+            similarity_cache_path,
+        )
+
+        # content-addressed image cache for !pic
+        self.init_image_cache(image_cache, image_cache_path, image_cache_size)
+
+        # per-backend circuit breakers
+        self.breakers = {
+            name: CircuitBreaker(name)
+            for name in ("openai", "bing", "bard", "bing image")
+        }
+        self.configure_breakers(
+            breaker_error_rate,
+            breaker_slow_call,
+            breaker_image_slow_call,
+            breaker_open_timeout,
+        )
+
+        # aiohttp session
+        self.session = aiohttp.ClientSession()
+
+        # summarize long !chat conversations, disabled without threshold
+        self.configure_compaction(compact_threshold, compact_target)
+
+        self.init_openai(
+            openai_api_key,
+            openai_api_endpoint,
+            openai_key_concurrency,
+            openai_engines,
+        )
+        self.init_bing(bing_api_endpoint)
+        self.init_bard(bard_token)
+        self.init_imagegen(bing_auth_cookie)
+
+        # regular expression to match keyword [!gpt {prompt}] [!chat {prompt}] [!bing {prompt}] [!pic {prompt}] [!bard {prompt}]
+        self.gpt_prog = re.compile(r"^\s*!gpt\s*(.+)$")
+        self.chat_prog = re.compile(r"^\s*!chat\s*(.+)$")
+        self.bing_prog = re.compile(r"^\s*!bing\s*(.+)$")
+        self.bard_prog = re.compile(r"^\s*!bard\s*(.+)$")
+        self.pic_prog = re.compile(r"^\s*!pic\s*(.+)$")
+        self.help_prog = re.compile(r"^\s*!help\s*.*$")
+        self.cancel_prog = re.compile(r"^\s*!cancel\s*$")
+        # ask all text backends at once, !first keeps only the fastest answer
+        self.all_prog = re.compile(r"^\s*!all\s*(.+)$")
+        self.first_prog = re.compile(r"^\s*!first\s*(.+)$")
+        # match @chatgpt mention
+        self.mention_prog = re.compile(
+            r"@" + re.escape(self.username.lstrip("@")) + r"\b", re.IGNORECASE
+        )
+
+    # initialize chatGPT class
+    def init_openai(
+        self,
+        openai_api_key: Optional[Union[str, list]],
+        openai_api_endpoint: Optional[Union[str, list]],
+        openai_key_concurrency: Optional[int] = None,
+        openai_engines: Optional[Union[str, list]] = None,
+    ) -> None:
         # openai_api_endpoint
         if openai_api_endpoint is None:
             self.openai_api_endpoint = "https://api.openai.com/v1/chat/completions"
         else:
             self.openai_api_endpoint = openai_api_endpoint
 
-        # aiohttp session
-        self.session = aiohttp.ClientSession()
-
         self.openai_api_key = openai_api_key
-        # initialize chatGPT class
         if self.openai_api_key is not None:
-            # request header for !gpt command
-            self.headers = {
-                "Content-Type": "application/json",
-                "Authorization": f"Bearer {self.openai_api_key}",
-            }
+            # balance requests across api keys
+            self.key_pool = KeyPool(
+                parse_list(self.openai_api_key),
+                max_concurrency=int(openai_key_concurrency or 8),
+            )
 
             self.askgpt = askGPT(
                 self.session,
                 self.openai_api_endpoint,
-                self.headers,
+                self.key_pool,
             )
 
-            self.chatbot = Chatbot(api_key=self.openai_api_key)
+            self.chatbot = Chatbot(
+                api_key=self.key_pool.keys[0].key,
+                api_url=openai_api_endpoint,
+                key_pool=self.key_pool,
+                compact_threshold=self.compact_threshold,
+                compact_target=self.compact_target,
+                # !chat is routed across engines by conversation size
+                engines=openai_engines,
+            )
         else:
             logger.warning(
                 "openai_api_key is not provided, !gpt and !chat command will not work"
             )
 
+    # initialize bingbot
+    def init_bing(self, bing_api_endpoint: Optional[str]) -> None:
         self.bing_api_endpoint = bing_api_endpoint
-        # initialize bingbot
         if self.bing_api_endpoint is not None:
             self.bingbot = BingBot(
                 session=self.session,
@@ -112,15 +281,17 @@ class Bot:
                 "bing_api_endpoint is not provided, !bing command will not work"
             )
 
+    # initialize bard
+    def init_bard(self, bard_token: Optional[str]) -> None:
         self.bard_token = bard_token
-        # initialize bard
         if self.bard_token is not None:
             self.bardbot = Bardbot(session_id=self.bard_token)
         else:
             logger.warning("bard_token is not provided, !bard command will not work")
 
+    # initialize image generator
+    def init_imagegen(self, bing_auth_cookie: Optional[str]) -> None:
         self.bing_auth_cookie = bing_auth_cookie
-        # initialize image generator
         if self.bing_auth_cookie is not None:
             self.imagegen = ImageGenAsync(auth_cookie=self.bing_auth_cookie)
         else:
@@ -128,78 +299,612 @@ class Bot:
                 "bing_auth_cookie is not provided, !pic command will not work"
             )
 
-        # regular expression to match keyword [!gpt {prompt}] [!chat {prompt}] [!bing {prompt}] [!pic {prompt}] [!bard {prompt}]
-        self.gpt_prog = re.compile(r"^\s*!gpt\s*(.+)$")
-        self.chat_prog = re.compile(r"^\s*!chat\s*(.+)$")
-        self.bing_prog = re.compile(r"^\s*!bing\s*(.+)$")
-        self.bard_prog = re.compile(r"^\s*!bard\s*(.+)$")
-        self.pic_prog = re.compile(r"^\s*!pic\s*(.+)$")
-        self.help_prog = re.compile(r"^\s*!help\s*.*$")
+    # initialize near-duplicate prompt cache
+    def init_similarity_cache(
+        self,
+        similarity_cache: Optional[bool],
+        similarity_threshold: Optional[float],
+        similarity_cache_size: Optional[int],
+        similarity_cache_path: Optional[str] = None,
+    ) -> None:
+        self.gpt_cache: Optional[SimilarityCache] = None
+        self.bing_cache: Optional[SimilarityCache] = None
+        # persisted between restarts and pre-populated by batch.py
+        self.similarity_store: Optional[StateStore] = None
+        if str(similarity_cache).lower() in ("true", "1", "yes"):
+            threshold = float(similarity_threshold or 0.8)
+            max_size = int(similarity_cache_size or 1000)
+            self.gpt_cache = SimilarityCache(threshold, max_size, name="gpt")
+            self.bing_cache = SimilarityCache(threshold, max_size, name="bing")
+            if similarity_cache_path:
+                self.similarity_store = StateStore(similarity_cache_path)
+                entries = self.similarity_store.load()
+                self.gpt_cache.load(entries.get("gpt", []))
+                self.bing_cache.load(entries.get("bing", []))
+
+    def save_similarity_cache(self) -> None:
+        if self.similarity_store is not None:
+            self.similarity_store.save(
+                {"gpt": self.gpt_cache.dump(), "bing": self.bing_cache.dump()}
+            )
+
+    # initialize image cache, size is in MB
+    def init_image_cache(
+        self,
+        image_cache: Optional[bool],
+        image_cache_path: Optional[str],
+        image_cache_size: Optional[int],
+    ) -> None:
+        self.image_cache: Optional[ImageCache] = None
+        if str(image_cache).lower() in ("true", "1", "yes"):
+            self.image_cache = ImageCache(
+                path=image_cache_path or "images/cache",
+                max_size=int(image_cache_size or 512) << 20,
+            )
+
+    # apply circuit breaker trip conditions
+    def configure_breakers(
+        self,
+        breaker_error_rate: Optional[float],
+        breaker_slow_call: Optional[float],
+        breaker_image_slow_call: Optional[float],
+        breaker_open_timeout: Optional[float],
+    ) -> None:
+        for breaker in self.breakers.values():
+            breaker.error_rate = float(breaker_error_rate or 0.5)
+            breaker.slow_call = float(breaker_slow_call or 60)
+            breaker.open_timeout = float(breaker_open_timeout or 30)
+        # image generation polls for up to 300s when healthy
+        self.breakers["bing image"].slow_call = float(breaker_image_slow_call or 300)
 
-    # close session
-    def __del__(self) -> None:
-        self.driver.disconnect()
+    # apply request deadlines and the slo load is shed at
+    def configure_deadlines(
+        self,
+        request_timeout: Optional[float],
+        image_request_timeout: Optional[float],
+        admission_slo: Optional[float],
+    ) -> None:
+        self.request_timeout = float(request_timeout or 120)
+        # image generation polls for up to 300s when healthy
+        self.image_request_timeout = float(image_request_timeout or 360)
+        self.admission.slo = float(admission_slo or self.request_timeout)
+        self.admission.command_slo["pic"] = max(
+            self.admission.slo, self.image_request_timeout
+        )
+
+    # seconds a request of command is allowed to take
+    def command_timeout(self, command: str) -> float:
+        if command == "pic":
+            return self.image_request_timeout
+        return self.request_timeout
+
+    # apply token thresholds of conversation compaction
+    def configure_compaction(
+        self,
+        compact_threshold: Optional[int],
+        compact_target: Optional[int],
+    ) -> None:
+        self.compact_threshold = int(compact_threshold) if compact_threshold else None
+        self.compact_target = int(compact_target) if compact_target else None
+        if getattr(self, "openai_api_key", None) is not None:
+            self.chatbot.compact_threshold = self.compact_threshold
+            self.chatbot.compact_target = self.compact_target
+
+    # apply changed config, only affected backend is rebuilt
+    async def reload(self, config: dict) -> None:
+        # keys not accepted by Bot, e.g. workers, are handled by main.py
+        changed = {
+            key
+            for key, value in config.items()
+            if key in self.config and value != self.config[key]
+        }
+        if not changed:
+            return
+        logger.info(f"reloading config: {', '.join(sorted(changed))}")
+        # old clients are closed after in-flight requests finish
+        retired = []
+
+        if changed & {
+            "openai_api_key",
+            "openai_api_endpoint",
+            "openai_key_concurrency",
+            "openai_engines",
+        }:
+            conversation = None
+            if self.openai_api_key is not None:
+                conversation = self.chatbot.conversation
+                retired.append(self.chatbot.close)
+            self.init_openai(
+                config["openai_api_key"],
+                config["openai_api_endpoint"],
+                config["openai_key_concurrency"],
+                config["openai_engines"],
+            )
+            if self.openai_api_key is not None and conversation is not None:
+                self.chatbot.conversation = conversation
+
+        if "bing_api_endpoint" in changed:
+            data = self.bingbot.data if self.bing_api_endpoint is not None else None
+            self.init_bing(config["bing_api_endpoint"])
+            if self.bing_api_endpoint is not None and data is not None:
+                self.bingbot.data = data
+
+        if "bard_token" in changed:
+            if self.bard_token is not None:
+                retired.append(self.bardbot.session.close)
+            self.init_bard(config["bard_token"])
+
+        if "bing_auth_cookie" in changed:
+            if self.bing_auth_cookie is not None:
+                retired.append(self.imagegen.close)
+            self.init_imagegen(config["bing_auth_cookie"])
+
+        if changed & {
+            "similarity_cache",
+            "similarity_threshold",
+            "similarity_cache_size",
+            "similarity_cache_path",
+        }:
+            self.init_similarity_cache(
+                config["similarity_cache"],
+                config["similarity_threshold"],
+                config["similarity_cache_size"],
+                config["similarity_cache_path"],
+            )
+
+        if changed & {"image_cache", "image_cache_path", "image_cache_size"}:
+            self.init_image_cache(
+                config["image_cache"],
+                config["image_cache_path"],
+                config["image_cache_size"],
+            )
+
+        if changed & {
+            "breaker_error_rate",
+            "breaker_slow_call",
+            "breaker_image_slow_call",
+            "breaker_open_timeout",
+        }:
+            self.configure_breakers(
+                config["breaker_error_rate"],
+                config["breaker_slow_call"],
+                config["breaker_image_slow_call"],
+                config["breaker_open_timeout"],
+            )
+
+        if changed & {"compact_threshold", "compact_target"}:
+            self.configure_compaction(
+                config["compact_threshold"], config["compact_target"]
+            )
+
+        if "metadata_ttl" in changed:
+            self.metadata.ttl = int(config["metadata_ttl"] or 600)
+        if "concurrency" in changed:
+            self.scheduler.resize(int(config["concurrency"] or 4))
+        if changed & {"user_max_requests", "user_max_tokens", "budget_window"}:
+            user_max_requests = config["user_max_requests"]
+            user_max_tokens = config["user_max_tokens"]
+            self.budget.max_requests = (
+                int(user_max_requests) if user_max_requests else None
+            )
+            self.budget.max_tokens = int(user_max_tokens) if user_max_tokens else None
+            self.budget.window = int(config["budget_window"] or 3600)
+        if "max_post_size" in changed:
+            self.poster.max_post_size = int(config["max_post_size"] or 16383)
+        if "state_path" in changed:
+            self.state_store.path = config["state_path"] or "state.json"
+        if changed & {"request_timeout", "image_request_timeout", "admission_slo"}:
+            self.configure_deadlines(
+                config["request_timeout"],
+                config["image_request_timeout"],
+                config["admission_slo"],
+            )
+        if "shutdown_timeout" in changed:
+            self.shutdown_timeout = int(config["shutdown_timeout"] or 30)
+
+        restart_keys = changed & {
+            "server_url",
+            "access_token",
+            "login_id",
+            "password",
+            "username",
+            "port",
+            "timeout",
+            "replica_index",
+            "replica_count",
+            "shard_dir",
+        }
+        if restart_keys:
+            logger.warning(
+                f"{', '.join(sorted(restart_keys))} change requires restart"
+            )
+        self.config.update(
+            {key: config[key] for key in changed if key not in restart_keys}
+        )
+
+        if retired:
+            self.retired.extend(retired)
+            task = asyncio.create_task(self.close_later(retired))
+            self.retire_tasks.add(task)
+            task.add_done_callback(self.retire_tasks.discard)
+
+    # close replaced clients once in-flight requests had time to finish
+    async def close_later(self, closers: list) -> None:
+        await asyncio.sleep(self.shutdown_timeout)
+        await self.close_retired(closers)
+
+    async def close_retired(self, closers: Optional[list] = None) -> None:
+        if closers is None:
+            closers = list(self.retired)
+        for close in closers:
+            if close not in self.retired:
+                continue
+            self.retired.remove(close)
+            try:
+                result = close()
+                if asyncio.iscoroutine(result):
+                    await result
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    async def __aenter__(self):
+        return self
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
-        await self.session.close()
+        await self.shutdown()
 
     def login(self) -> None:
         self.driver.login()
+        # resolve bot user id once
+        self.metadata.resolve_bot_user()
 
     async def run(self) -> None:
+        await self.shard.start()
+        self.restore_state(self.state_store.load())
+        self.scheduler.start()
         await self.driver.init_websocket(self.websocket_handler)
 
+    # handle websocket messages forwarded by ingestor process, None stops
+    async def serve(self, queue) -> None:
+        await self.shard.start()
+        self.restore_state(self.state_store.load())
+        self.scheduler.start()
+        while True:
+            message = await asyncio.to_thread(queue.get)
+            if message is None:
+                break
+            try:
+                await self.websocket_handler(message)
+            except Exception as e:
+                logger.error(e, exc_info=True)
+
+    # stop accepting new events, drain in-flight requests and close sessions
+    async def shutdown(self, timeout: Optional[float] = None) -> None:
+        if not self.accepting:
+            return
+        self.accepting = False
+        # hand channels over to live replicas while draining
+        self.shard.stop()
+        if timeout is None:
+            timeout = self.shutdown_timeout
+        logger.info("shutting down, draining in-flight requests")
+        await self.scheduler.drain(timeout)
+        if self.tasks:
+            await asyncio.wait(self.tasks, timeout=timeout)
+
+        try:
+            self.state_store.save(self.snapshot_state())
+            self.save_similarity_cache()
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+        await self.close()
+
+    # close all http sessions
+    async def close(self) -> None:
+        self.shard.stop()
+        for task in self.retire_tasks:
+            task.cancel()
+        await self.close_retired()
+        if self.openai_api_key is not None:
+            await self.chatbot.close()
+        if self.bard_token is not None:
+            self.bardbot.session.close()
+        if self.bing_auth_cookie is not None:
+            await self.imagegen.close()
+        await self.session.close()
+        # workers and a bot stopped before run() never open a websocket
+        if self.driver.websocket is not None:
+            self.driver.disconnect()
+
+    # snapshot conversation state of all backends
+    def snapshot_state(self) -> dict:
+        state = {}
+        if self.openai_api_key is not None:
+            state["chatbot"] = self.chatbot.dump_conversation()
+        if self.bing_api_endpoint is not None:
+            state["bingbot"] = self.bingbot.data
+        if self.bard_token is not None:
+            state["bardbot"] = {
+                "conversation_id": self.bardbot.conversation_id,
+                "response_id": self.bardbot.response_id,
+                "choice_id": self.bardbot.choice_id,
+            }
+        return state
+
+    # resume conversation state saved by previous process
+    def restore_state(self, state: dict) -> None:
+        if self.openai_api_key is not None and "chatbot" in state:
+            self.chatbot.load_conversation(state["chatbot"])
+        if self.bing_api_endpoint is not None and "bingbot" in state:
+            self.bingbot.data.update(state["bingbot"])
+        if self.bard_token is not None and "bardbot" in state:
+            self.bardbot.conversation_id = state["bardbot"]["conversation_id"]
+            self.bardbot.response_id = state["bardbot"]["response_id"]
+            self.bardbot.choice_id = state["bardbot"]["choice_id"]
+        if state:
+            logger.info("conversation state restored")
+
     # websocket handler
     async def websocket_handler(self, message) -> None:
         print(message)
         response = json.loads(message)
         if "event" in response:
+            self.metadata.handle_event(response)
             event_type = response["event"]
-            if event_type == "posted":
+            # deleting or editing the triggering post cancels its request
+            if event_type in ("post_deleted", "post_edited"):
+                post_id = json.loads(response["data"]["post"])["id"]
+                self.cancel_request(post_id)
+
+            # stop accepting new requests while shutting down
+            if event_type == "posted" and self.accepting:
                 raw_data = response["data"]["post"]
                 raw_data_dict = json.loads(raw_data)
+                post_id = raw_data_dict["id"]
                 user_id = raw_data_dict["user_id"]
                 channel_id = raw_data_dict["channel_id"]
                 sender_name = response["data"]["sender_name"]
                 raw_message = raw_data_dict["message"]
-                try:
-                    asyncio.create_task(
-                        self.message_callback(
-                            raw_message, channel_id, user_id, sender_name
+                # prevent command trigger loop
+                if self.is_self(user_id, sender_name):
+                    return
+                # channel belongs to another replica
+                if not self.shard.owns(channel_id):
+                    return
+                mentioned = self.metadata.is_mentioned(response["data"])
+                if not (
+                    self.is_command(raw_message)
+                    or mentioned
+                    or await self.is_direct(channel_id)
+                ):
+                    return
+
+                # !cancel running and queued requests of the user in this channel
+                if self.cancel_prog.match(raw_message):
+                    count = self.cancel_user_requests(channel_id, user_id)
+                    await self.send_message(
+                        channel_id, f"{sender_name} {count} request(s) cancelled"
+                    )
+                    return
+
+                # !help is cheap, bypass queue and budget
+                if self.help_prog.match(raw_message):
+                    task = asyncio.create_task(
+                        self.process_message(
+                            post_id,
+                            raw_message,
+                            channel_id,
+                            user_id,
+                            sender_name,
+                            mentioned,
                         )
                     )
-                except Exception as e:
-                    await asyncio.to_thread(self.send_message, channel_id, f"{e}")
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                    return
+
+                # reject early instead of timing out under overload
+                command = self.command_name(raw_message)
+                if not self.admission.admit(
+                    command,
+                    self.scheduler.pending(),
+                    self.scheduler.running,
+                    self.scheduler.concurrency,
+                ):
+                    await self.send_message(
+                        channel_id,
+                        f"{sender_name} I'm busy now, please try again later",
+                    )
+                    return
+
+                # reject over-budget request immediately
+                reason = self.budget.check(user_id)
+                if reason is not None:
+                    retry_after = self.budget.retry_after(user_id)
+                    await self.send_message(
+                        channel_id,
+                        f"{sender_name} you have used up your {reason}, "
+                        + f"please retry in {retry_after} seconds",
+                    )
+                    return
+
+                usage = self.budget.charge_request(user_id)
+                # image generation takes much more backend capacity
+                cost = 5 if self.pic_prog.match(raw_message) else 1
+                # fan-out keeps every text backend busy
+                if self.all_prog.match(raw_message) or self.first_prog.match(
+                    raw_message
+                ):
+                    cost = len(self.fan_out_backends()) or 1
+                self.requests[post_id] = (channel_id, user_id, None)
+                self.scheduler.submit(
+                    user_id,
+                    functools.partial(
+                        self.process_message,
+                        post_id,
+                        raw_message,
+                        channel_id,
+                        user_id,
+                        sender_name,
+                        mentioned,
+                        usage,
+                        queued_at=time.monotonic(),
+                    ),
+                    cost,
+                )
+
+    # check whether message matches any command
+    def is_command(self, message: str) -> bool:
+        return any(
+            prog.match(message)
+            for prog in (
+                self.gpt_prog,
+                self.chat_prog,
+                self.bing_prog,
+                self.bard_prog,
+                self.pic_prog,
+                self.help_prog,
+                self.cancel_prog,
+                self.all_prog,
+                self.first_prog,
+            )
+        )
+
+    # command name used by admission control
+    def command_name(self, message: str) -> str:
+        for name, prog in (
+            ("gpt", self.gpt_prog),
+            ("chat", self.chat_prog),
+            ("bing", self.bing_prog),
+            ("bard", self.bard_prog),
+            ("pic", self.pic_prog),
+            ("all", self.all_prog),
+            ("first", self.first_prog),
+        ):
+            if prog.match(message):
+                return name
+        # @mention or direct message
+        return "chat"
+
+    # run message callback within deadline and report error to room
+    async def process_message(
+        self,
+        post_id: str,
+        raw_message: str,
+        channel_id: str,
+        user_id: str,
+        *args,
+        queued_at: Optional[float] = None,
+    ) -> None:
+        # cancelled while waiting in queue
+        if post_id in self.cancelled:
+            self.cancelled.discard(post_id)
+            return
+
+        start = time.monotonic()
+        if queued_at is not None:
+            self.admission.record_wait(start - queued_at)
+
+        # deadline is inherited by the task context
+        command = self.command_name(raw_message)
+        timeout = self.command_timeout(command)
+        set_deadline(timeout)
+        task = asyncio.create_task(
+            self.message_callback(raw_message, channel_id, user_id, *args)
+        )
+        self.requests[post_id] = (channel_id, user_id, task)
+        try:
+            await asyncio.wait({task}, timeout=timeout)
+        except asyncio.CancelledError:
+            # worker is stopped
+            task.cancel()
+            raise
+        finally:
+            self.requests.pop(post_id, None)
+
+        if task.cancelled():
+            logger.info(f"request {post_id} cancelled")
+            return
+        # timeouts and failures count so a hanging backend raises the prediction
+        if queued_at is not None:
+            self.admission.record_latency(
+                command, time.monotonic() - start if task.done() else timeout
+            )
+        if not task.done() or isinstance(task.exception(), asyncio.TimeoutError):
+            task.cancel()
+            await self.send_message(channel_id, "Request timed out, please retry")
+        elif task.exception() is not None:
+            await self.send_message(channel_id, f"{task.exception()}")
+
+    # cancel request triggered by the post, return whether it was found
+    def cancel_request(self, post_id: str) -> bool:
+        if post_id not in self.requests:
+            return False
+        task = self.requests.pop(post_id)[2]
+        if task is None:
+            # still queued, skip when dequeued
+            self.cancelled.add(post_id)
+        else:
+            task.cancel()
+        return True
+
+    # cancel all requests of a user in a channel
+    def cancel_user_requests(self, channel_id: str, user_id: str) -> int:
+        post_ids = [
+            post_id
+            for post_id, (request_channel_id, request_user_id, _) in list(
+                self.requests.items()
+            )
+            if request_channel_id == channel_id and request_user_id == user_id
+        ]
+        return sum(self.cancel_request(post_id) for post_id in post_ids)
+
+    # check whether a post is sent by bot itself
+    def is_self(self, user_id: str, sender_name: str) -> bool:
+        if self.metadata.bot_user_id is not None:
+            return user_id == self.metadata.bot_user_id
+        return sender_name == self.username
 
     # message callback
     async def message_callback(
-        self, raw_message: str, channel_id: str, user_id: str, sender_name: str
+        self,
+        raw_message: str,
+        channel_id: str,
+        user_id: str,
+        sender_name: str,
+        mentioned: bool = False,
+        usage: Optional[list] = None,
     ) -> None:
         # prevent command trigger loop
-        if sender_name != self.username:
+        if not self.is_self(user_id, sender_name):
             message = raw_message
+            matched = False
 
             if self.openai_api_key is not None:
                 # !gpt command trigger handler
                 if self.gpt_prog.match(message):
+                    matched = True
                     prompt = self.gpt_prog.match(message).group(1)
                     try:
                         response = await self.gpt(prompt)
-                        await asyncio.to_thread(
-                            self.send_message, channel_id, f"{response}"
-                        )
+                        await self.send_message(channel_id, f"{response}")
+                        self.charge_usage(usage, self.count_tokens(prompt, response))
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
 
                 # !chat command trigger handler
                 elif self.chat_prog.match(message):
+                    matched = True
                     prompt = self.chat_prog.match(message).group(1)
                     try:
-                        response = await self.chat(prompt)
-                        await asyncio.to_thread(
-                            self.send_message, channel_id, f"{response}"
+                        response = await self.chat(prompt, channel_id)
+                        await self.send_message(channel_id, f"{response}")
+                        self.charge_usage(
+                            usage, self.chatbot.get_token_count(channel_id)
                         )
+                        self.compact_later(channel_id)
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
@@ -207,12 +912,12 @@ class Bot:
             if self.bing_api_endpoint is not None:
                 # !bing command trigger handler
                 if self.bing_prog.match(message):
+                    matched = True
                     prompt = self.bing_prog.match(message).group(1)
                     try:
-                        response = await self.bingbot.ask_bing(prompt)
-                        await asyncio.to_thread(
-                            self.send_message, channel_id, f"{response}"
-                        )
+                        response = await self.bing(prompt)
+                        await self.send_message(channel_id, f"{response}")
+                        self.charge_usage(usage, self.count_tokens(prompt, response))
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
@@ -220,14 +925,14 @@ class Bot:
             if self.bard_token is not None:
                 # !bard command trigger handler
                 if self.bard_prog.match(message):
+                    matched = True
                     prompt = self.bard_prog.match(message).group(1)
                     try:
                         # response is dict object
                         response = await self.bard(prompt)
                         content = str(response["content"]).strip()
-                        await asyncio.to_thread(
-                            self.send_message, channel_id, f"{content}"
-                        )
+                        await self.send_message(channel_id, f"{content}")
+                        self.charge_usage(usage, self.count_tokens(prompt, content))
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
@@ -235,83 +940,311 @@ class Bot:
             if self.bing_auth_cookie is not None:
                 # !pic command trigger handler
                 if self.pic_prog.match(message):
+                    matched = True
                     prompt = self.pic_prog.match(message).group(1)
-                    # generate image
                     try:
-                        links = await self.imagegen.get_images(prompt)
-                        image_path = await self.imagegen.save_images(links, "images")
+                        await self.pic(channel_id, prompt)
                     except Exception as e:
                         logger.error(e, exc_info=True)
                         raise Exception(e)
 
-                    # send image
-                    try:
-                        await asyncio.to_thread(
-                            self.send_file, channel_id, prompt, image_path
-                        )
-                    except Exception as e:
-                        logger.error(e, exc_info=True)
-                        raise Exception(e)
+            # !all and !first command trigger handler
+            if self.all_prog.match(message) or self.first_prog.match(message):
+                matched = True
+                first = self.first_prog.match(message) is not None
+                prompt = (self.first_prog if first else self.all_prog).match(
+                    message
+                ).group(1)
+                try:
+                    answers = await self.fan_out(channel_id, prompt, first=first)
+                    self.charge_usage(usage, self.count_tokens(prompt, *answers))
+                except Exception as e:
+                    logger.error(e, exc_info=True)
+                    raise Exception(e)
 
             # !help command trigger handler
             if self.help_prog.match(message):
+                matched = True
                 try:
-                    await asyncio.to_thread(self.send_message, channel_id, self.help())
+                    await self.send_message(channel_id, self.help())
                 except Exception as e:
                     logger.error(e, exc_info=True)
 
+            # @mention or direct message trigger handler, works as !chat
+            if not matched and self.openai_api_key is not None:
+                if mentioned or await self.is_direct(channel_id):
+                    prompt = self.mention_prog.sub("", message).strip()
+                    if prompt and not await self.is_bot_user(user_id):
+                        try:
+                            response = await self.chat(prompt, channel_id)
+                            await self.send_message(channel_id, f"{response}")
+                            self.charge_usage(
+                                usage, self.chatbot.get_token_count(channel_id)
+                            )
+                            self.compact_later(channel_id)
+                        except Exception as e:
+                            logger.error(e, exc_info=True)
+                            raise Exception(e)
+
+    # token usage of texts, used by per-user token budget
+    def count_tokens(self, *texts: str) -> int:
+        if self.openai_api_key is not None:
+            return sum(self.chatbot.count_tokens(text) for text in texts)
+        # rough estimation without tiktoken encoding
+        return sum(len(text) // 4 for text in texts)
+
+    # charge token usage to per-user budget
+    def charge_usage(self, usage: Optional[list], tokens: int) -> None:
+        if usage is not None:
+            self.budget.charge_tokens(usage, tokens)
+
+    # check whether channel is a direct message channel
+    async def is_direct(self, channel_id: str) -> bool:
+        try:
+            return await self.metadata.get_channel_type(channel_id) == "D"
+        except Exception as e:
+            logger.warning(f"failed to get channel type: {e}")
+            return False
+
+    # ignore other bots to prevent bot to bot loop
+    async def is_bot_user(self, user_id: str) -> bool:
+        try:
+            return bool((await self.metadata.get_user(user_id)).get("is_bot"))
+        except Exception as e:
+            logger.warning(f"failed to get user profile: {e}")
+            return False
+
     # send message to room
-    def send_message(self, channel_id: str, message: str) -> None:
-        self.driver.posts.create_post(
-            options={
-                "channel_id": channel_id,
-                "message": message,
-            }
-        )
+    async def send_message(self, channel_id: str, message: str) -> None:
+        await self.poster.create_post(channel_id, message)
 
     # send file to room
-    def send_file(self, channel_id: str, message: str, filepath: str) -> None:
+    async def send_file(
+        self, channel_id: str, message: str, filepath: str, remove: bool = True
+    ) -> None:
         filename = os.path.split(filepath)[-1]
         try:
-            file_id = self.driver.files.upload_file(
-                channel_id=channel_id,
-                files={
-                    "files": (filename, open(filepath, "rb")),
-                },
+            with open(filepath, "rb") as fp:
+                content = fp.read()
+            file_id = (
+                await self.poster.upload_file(
+                    channel_id,
+                    files={
+                        "files": (filename, content),
+                    },
+                )
             )["file_infos"][0]["id"]
         except Exception as e:
             logger.error(e, exc_info=True)
             raise Exception(e)
 
         try:
-            self.driver.posts.create_post(
-                options={
-                    "channel_id": channel_id,
-                    "message": message,
-                    "file_ids": [file_id],
-                }
-            )
+            await self.poster.create_post(channel_id, message, file_ids=[file_id])
             # remove image after posting
-            os.remove(filepath)
+            if remove:
+                os.remove(filepath)
         except Exception as e:
             logger.error(e, exc_info=True)
             raise Exception(e)
 
     # !gpt command function
     async def gpt(self, prompt: str) -> str:
-        return await self.askgpt.oneTimeAsk(prompt)
+        if self.gpt_cache is not None:
+            response = self.gpt_cache.get(prompt)
+            if response is not None:
+                return response
+        response = await self.breakers["openai"].call(
+            self.askgpt.oneTimeAsk,
+            prompt,
+            timeout=remaining(120),
+            is_failure=lambda r: r is None,
+        )
+        if self.gpt_cache is not None and response is not None:
+            self.gpt_cache.put(prompt, response)
+        return response
 
     # !chat command function
-    async def chat(self, prompt: str) -> str:
-        return await self.chatbot.ask_async(prompt)
+    async def chat(self, prompt: str, channel_id: str) -> str:
+        # each channel keeps its own conversation
+        return await self.breakers["openai"].call(
+            self.chatbot.ask_async,
+            prompt,
+            convo_id=channel_id,
+            timeout=remaining(self.chatbot.timeout),
+        )
+
+    # summarize older turns after the reply is posted, off the request path
+    def compact_later(self, channel_id: str) -> None:
+        if not self.chatbot.needs_compaction(channel_id):
+            return
+        task = asyncio.create_task(self.compact(channel_id))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def compact(self, channel_id: str) -> None:
+        # not bound by the deadline of the request that triggered it
+        current_deadline.set(None)
+        try:
+            compacted = await self.breakers["openai"].call(
+                self.chatbot.compact_conversation,
+                channel_id,
+                timeout=self.request_timeout,
+            )
+        except Exception as e:
+            logger.warning(f"failed to compact conversation {channel_id}: {e}")
+            return
+        if compacted:
+            tokens = self.chatbot.get_token_count(channel_id)
+            logger.info(f"conversation {channel_id} compacted to {tokens} tokens")
 
     # !bing command function
     async def bing(self, prompt: str) -> str:
-        return await self.bingbot.ask_bing(prompt)
+        if self.bing_cache is not None:
+            response = self.bing_cache.get(prompt)
+            if response is not None:
+                return response
+        response = await self.breakers["bing"].call(
+            self.bingbot.ask_bing,
+            prompt,
+            timeout=remaining(120),
+            is_failure=lambda r: r == "Error, please retry",
+        )
+        # don't cache failure message
+        if self.bing_cache is not None and response != "Error, please retry":
+            self.bing_cache.put(prompt, response)
+        return response
+
+    # !pic command function
+    async def pic(self, channel_id: str, prompt: str) -> None:
+        if self.image_cache is not None:
+            # upload cached image, mattermost attaches a file to one post only
+            for blob_path in self.image_cache.get_blobs(prompt)[:1]:
+                await self.send_file(channel_id, prompt, blob_path, remove=False)
+                return
+
+        # generate image
+        links = await self.breakers["bing image"].call(
+            self.imagegen.get_images, prompt, timeout=min(remaining(300), 300)
+        )
+        image_path = await self.imagegen.save_images(links, "images")
+
+        # send image
+        if self.image_cache is not None:
+            blob_path = self.image_cache.add_blob(prompt, image_path)
+            await self.send_file(channel_id, prompt, blob_path, remove=False)
+        else:
+            await self.send_file(channel_id, prompt, image_path)
 
     # !bard command function
     async def bard(self, prompt: str) -> str:
-        return await asyncio.to_thread(self.bardbot.ask, prompt)
+        return await self.breakers["bard"].call(
+            asyncio.to_thread,
+            self.bardbot.ask,
+            prompt,
+            timeout=remaining(120),
+            is_failure=lambda r: str(r["content"]).startswith(
+                "Google Bard encountered an error"
+            ),
+        )
+
+    # text backends used by !all and !first, name -> command function
+    def fan_out_backends(self) -> dict:
+        backends = {}
+        if self.openai_api_key is not None:
+            backends["ChatGPT"] = self.gpt
+        if self.bing_api_endpoint is not None:
+            backends["Bing"] = self.bing
+        if self.bard_token is not None:
+            backends["Bard"] = self.bard_text
+        return backends
+
+    async def bard_text(self, prompt: str) -> str:
+        response = await self.bard(prompt)
+        return str(response["content"]).strip()
+
+    # answer of a finished fan-out task, None if the backend failed
+    def fan_out_answer(self, task: asyncio.Task) -> Optional[str]:
+        if task.cancelled() or task.exception() is not None:
+            return None
+        answer = task.result()
+        if not answer or answer == "Error, please retry":
+            return None
+        return answer
+
+    # !all and !first command function, return answers for token usage
+    async def fan_out(self, channel_id: str, prompt: str, first: bool) -> list:
+        backends = self.fan_out_backends()
+        if not backends:
+            raise Exception("No backend is available")
+        # backend tasks inherit the request deadline
+        tasks = {
+            asyncio.create_task(command(prompt)): name
+            for name, command in backends.items()
+        }
+        sections = {name: "_waiting..._" for name in backends}
+        answers: list = []
+        post = None
+        try:
+            if not first:
+                post = await self.poster.create_post(
+                    channel_id, self.render_sections(sections)
+                )
+            while tasks:
+                done, _ = await asyncio.wait(
+                    tasks, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    name = tasks.pop(task)
+                    answer = self.fan_out_answer(task)
+                    if answer is None:
+                        logger.warning(f"{name} failed in fan-out")
+                        sections[name] = "_failed, please retry_"
+                        continue
+                    answers.append(answer)
+                    sections[name] = answer
+                    if post is None:
+                        # fastest answer wins, the rest are cancelled
+                        await self.send_message(channel_id, f"**{name}**\n{answer}")
+                        return answers
+                    if len(self.render_sections(sections)) > self.poster.max_post_size:
+                        # too long for a single post
+                        sections[name] = "_answer is posted below_"
+                        await self.send_message(channel_id, f"**{name}**\n{answer}")
+                if post is not None:
+                    await self.poster.update_post(
+                        post["id"], self.render_sections(sections)
+                    )
+        finally:
+            try:
+                if post is not None and tasks:
+                    await self.close_sections(post, sections, tasks.values())
+            finally:
+                for task in tasks:
+                    task.cancel()
+        if not answers:
+            raise Exception("All backends failed, please retry")
+        return answers
+
+    # mark sections of backends stopped by the deadline or !cancel
+    async def close_sections(self, post: dict, sections: dict, names) -> None:
+        deadline = current_deadline.get()
+        if deadline is not None and time.monotonic() >= deadline:
+            status = "_timed out_"
+        else:
+            status = "_cancelled_"
+        for name in names:
+            sections[name] = status
+        try:
+            # the request task is being cancelled, finish the update anyway
+            await asyncio.shield(
+                self.poster.update_post(post["id"], self.render_sections(sections))
+            )
+        except Exception as e:
+            logger.error(e, exc_info=True)
+
+    # one post section per backend
+    def render_sections(self, sections: dict) -> str:
+        return "\n\n".join(f"**{name}**\n{text}" for name, text in sections.items())
 
     # !help command function
     def help(self) -> str:
@@ -321,6 +1254,10 @@ class Bot:
             + "!bing [content], chat with context conversation powered by Bing AI\n"
             + "!bard [content], chat with Google's Bard\n"
             + "!pic [prompt], Image generation by Microsoft Bing\n"
-            + "!help, help message"
+            + "!all [content], ask ChatGPT, Bing and Bard at once\n"
+            + "!first [content], ask ChatGPT, Bing and Bard, keep the fastest answer\n"
+            + "!cancel, cancel your running requests in this channel\n"
+            + "!help, help message\n"
+            + "@mention or direct message the bot to chat with context conversation"
         )
         return help_info
@@ -0,0 +1,120 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+from deadline import current_deadline, remaining
+from log import getlogger
+
+logger = getlogger()
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Per-backend circuit breaker with closed, open and half-open states
+    Parameters:
+        name: str, backend name shown to users
+        error_rate: float, failure ratio of recent calls that trips the circuit
+        slow_call: float, calls slower than this many seconds count as failure
+        window: int, number of recent calls considered
+        min_calls: int, minimum calls in window before tripping
+        open_timeout: float, seconds before a probe is let through
+        probes: int, concurrent probe calls in half-open state
+    """
+
+    def __init__(
+        self,
+        name: str,
+        error_rate: float = 0.5,
+        slow_call: float = 60,
+        window: int = 20,
+        min_calls: int = 5,
+        open_timeout: float = 30,
+        probes: int = 1,
+    ) -> None:
+        self.name = name
+        self.error_rate = error_rate
+        self.slow_call = slow_call
+        self.window = window
+        self.min_calls = min_calls
+        self.open_timeout = open_timeout
+        self.probes = probes
+        self.state = "closed"
+        self.opened_at = 0.0
+        self.probing = 0
+        # True means failed call
+        self.results: deque = deque(maxlen=window)
+
+    def allow(self) -> None:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.open_timeout:
+                raise CircuitOpenError(
+                    f"{self.name} is down at the moment, please try again later"
+                )
+            self.state = "half_open"
+            self.probing = 0
+            logger.info(f"{self.name} circuit half open, probing")
+        if self.state == "half_open":
+            if self.probing >= self.probes:
+                raise CircuitOpenError(
+                    f"{self.name} is recovering, please try again later"
+                )
+            self.probing += 1
+
+    def record(self, failed: bool) -> None:
+        if self.state == "half_open":
+            self.probing -= 1
+            if failed:
+                self.trip()
+            else:
+                self.state = "closed"
+                self.results.clear()
+                logger.info(f"{self.name} circuit closed")
+            return
+
+        self.results.append(failed)
+        if (
+            self.state == "closed"
+            and len(self.results) >= self.min_calls
+            and sum(self.results) / len(self.results) >= self.error_rate
+        ):
+            self.trip()
+
+    def trip(self) -> None:
+        self.state = "open"
+        self.opened_at = time.monotonic()
+        logger.warning(f"{self.name} circuit open")
+
+    async def call(
+        self,
+        func: Callable[..., Awaitable[Any]],
+        *args,
+        is_failure: Optional[Callable[[Any], bool]] = None,
+        **kwargs,
+    ) -> Any:
+        self.allow()
+        start = time.monotonic()
+        try:
+            # a hanging backend fails at the request deadline
+            timeout = remaining()
+            result = await asyncio.wait_for(func(*args, **kwargs), timeout)
+        except asyncio.CancelledError:
+            deadline = current_deadline.get()
+            if deadline is not None and time.monotonic() >= deadline:
+                # cancelled by the deadline of the request
+                self.record(True)
+            elif self.state == "half_open":
+                # cancelled by user, not a backend failure
+                self.probing -= 1
+            raise
+        except Exception:
+            self.record(True)
+            raise
+        failed = time.monotonic() - start > self.slow_call
+        if is_failure is not None and is_failure(result):
+            failed = True
+        self.record(failed)
+        return result
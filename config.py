@@ -0,0 +1,126 @@
+import asyncio
+import json
+import os
+from typing import Awaitable, Callable, Union
+from log import getlogger
+
+logger = getlogger()
+
+# keys accepted by Bot, environment variable name is the upper case key
+CONFIG_KEYS = (
+    "server_url",
+    "access_token",
+    "login_id",
+    "password",
+    "username",
+    "openai_api_key",
+    "openai_api_endpoint",
+    "bing_api_endpoint",
+    "bard_token",
+    "bing_auth_cookie",
+    "port",
+    "timeout",
+    "metadata_ttl",
+    "concurrency",
+    "user_max_requests",
+    "user_max_tokens",
+    "budget_window",
+    "max_post_size",
+    "state_path",
+    "shutdown_timeout",
+    "similarity_cache",
+    "similarity_threshold",
+    "similarity_cache_size",
+    "image_cache",
+    "image_cache_path",
+    "image_cache_size",
+    "breaker_error_rate",
+    "breaker_slow_call",
+    "breaker_image_slow_call",
+    "breaker_open_timeout",
+    "request_timeout",
+    "image_request_timeout",
+    "admission_slo",
+    "openai_key_concurrency",
+    "replica_index",
+    "replica_count",
+    "shard_dir",
+    "compact_threshold",
+    "compact_target",
+    "openai_engines",
+    "similarity_cache_path",
+)
+
+# keys used by main.py only
+PROCESS_KEYS = ("workers",)
+
+
+def parse_list(value: Union[str, list, None]) -> list:
+    """
+    Accept a list, a comma separated string or None
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        value = value.split(",")
+    return [item.strip() for item in value if item.strip()]
+
+
+# read config.json if exists, otherwise environment variables
+def load_config(path: str = "config.json") -> dict:
+    if os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as fp:
+            config = json.load(fp)
+        return {key: config.get(key) for key in CONFIG_KEYS + PROCESS_KEYS}
+
+    return {key: os.environ.get(key.upper()) for key in CONFIG_KEYS + PROCESS_KEYS}
+
+
+class ConfigWatcher:
+    """
+    Reload config when config file changes or on demand (SIGHUP)
+    Parameters:
+        path: str
+        callback: coroutine function called with the new config
+        interval: float, seconds between file checks
+    """
+
+    def __init__(
+        self,
+        path: str,
+        callback: Callable[[dict], Awaitable[None]],
+        interval: float = 5,
+    ) -> None:
+        self.path = path
+        self.callback = callback
+        self.interval = interval
+        self.mtime = self._mtime()
+        self.event = asyncio.Event()
+
+    def _mtime(self) -> float:
+        try:
+            return os.stat(self.path).st_mtime
+        except OSError:
+            return 0.0
+
+    # force a reload, used as SIGHUP handler
+    def trigger(self) -> None:
+        self.event.set()
+
+    async def watch(self) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(self.event.wait(), timeout=self.interval)
+            except asyncio.TimeoutError:
+                pass
+            mtime = self._mtime()
+            if not self.event.is_set() and mtime == self.mtime:
+                continue
+            self.event.clear()
+            self.mtime = mtime
+            try:
+                config = load_config(self.path)
+                await self.callback(config)
+            except Exception as e:
+                # keep running with current config, e.g. file is half written
+                logger.error(f"failed to reload config: {e}", exc_info=True)
@@ -0,0 +1,22 @@
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+# absolute deadline (time.monotonic) of the request handled in current task
+current_deadline: ContextVar[Optional[float]] = ContextVar("deadline", default=None)
+
+
+def set_deadline(timeout: float) -> None:
+    current_deadline.set(time.monotonic() + timeout)
+
+
+# seconds left before deadline, default is used outside of a request
+def remaining(default: Optional[float] = None) -> Optional[float]:
+    deadline = current_deadline.get()
+    if deadline is None:
+        return default
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise asyncio.TimeoutError("request deadline exceeded")
+    return left
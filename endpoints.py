@@ -0,0 +1,136 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+from log import getlogger
+
+logger = getlogger()
+
+
+class ClientError(Exception):
+    """
+    Request rejected by the api, e.g. 400 or 401, retrying it elsewhere fails too
+    """
+
+
+# error of a non 200 response, throttling and server errors are retried
+def status_error(status: int, text: str) -> Exception:
+    if 400 <= status < 500 and status not in (408, 429):
+        return ClientError(f"{status} {text}")
+    return Exception(f"{status} {text}")
+
+
+class EndpointPool:
+    """
+    OpenAI compatible endpoints with hedged requests and health-weighted failover
+    Parameters:
+        endpoints: list of api urls
+        quantile: float, latency quantile after which a hedged request is sent
+        min_delay: float, lower bound of hedge delay in seconds
+        initial_delay: float, hedge delay before enough latency is observed
+        window: int, number of latency samples kept
+    """
+
+    def __init__(
+        self,
+        endpoints: list,
+        quantile: float = 0.95,
+        min_delay: float = 0.5,
+        initial_delay: float = 5,
+        window: int = 100,
+    ) -> None:
+        self.endpoints = endpoints
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.initial_delay = initial_delay
+        self.latencies: deque = deque(maxlen=window)
+        # moving average of success, 1.0 is healthy
+        self.health = {endpoint: 1.0 for endpoint in endpoints}
+
+    def choose(self, exclude: Optional[list] = None) -> str:
+        candidates = [
+            endpoint for endpoint in self.endpoints if endpoint not in (exclude or [])
+        ] or self.endpoints
+        # unhealthy endpoints keep a small share so they can recover
+        weights = [max(self.health[endpoint], 0.05) for endpoint in candidates]
+        return random.choices(candidates, weights=weights)[0]
+
+    def hedge_delay(self) -> float:
+        if len(self.latencies) < 10:
+            return self.initial_delay
+        samples = sorted(self.latencies)
+        index = min(int(len(samples) * self.quantile), len(samples) - 1)
+        return max(samples[index], self.min_delay)
+
+    def record_success(self, endpoint: str, latency: float) -> None:
+        self.latencies.append(latency)
+        self.health[endpoint] = 0.8 * self.health[endpoint] + 0.2
+
+    def record_failure(self, endpoint: str) -> None:
+        self.health[endpoint] = 0.8 * self.health[endpoint]
+
+    async def request(
+        self,
+        attempt: Callable[[str], Awaitable[Any]],
+        max_attempts: int = 2,
+        discard: Optional[Callable[[Any], Awaitable[None]]] = None,
+    ) -> Any:
+        """
+        Run attempt against endpoints, the first successful result wins
+        Parameters:
+            attempt: coroutine function called with an endpoint
+            max_attempts: int, total attempts including hedged ones
+            discard: coroutine function to release an unused result
+        """
+        tasks: dict[asyncio.Task, tuple[str, float]] = {}
+        tried: list = []
+        last_error: Optional[BaseException] = None
+
+        def launch() -> None:
+            endpoint = self.choose(exclude=tried)
+            tried.append(endpoint)
+            tasks[asyncio.create_task(attempt(endpoint))] = (endpoint, time.monotonic())
+
+        launch()
+        try:
+            while tasks:
+                timeout = None
+                if len(tasks) == 1 and len(self.endpoints) > 1:
+                    if len(tried) < max_attempts:
+                        timeout = self.hedge_delay()
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # first endpoint is slow, fire a hedged request
+                    logger.info("sending hedged request")
+                    launch()
+                    continue
+
+                result, found = None, False
+                for task in done:
+                    endpoint, start = tasks.pop(task)
+                    if isinstance(task.exception(), ClientError):
+                        # the endpoint is fine, the request is not
+                        raise task.exception()
+                    if task.exception() is not None:
+                        self.record_failure(endpoint)
+                        last_error = task.exception()
+                        logger.warning(f"{endpoint} failed: {last_error}")
+                    elif not found:
+                        self.record_success(endpoint, time.monotonic() - start)
+                        result, found = task.result(), True
+                    elif discard is not None:
+                        await discard(task.result())
+                if found:
+                    return result
+
+                # fail over to another endpoint
+                if not tasks and len(tried) < max_attempts:
+                    await asyncio.sleep(0 if len(self.endpoints) > 1 else 2)
+                    launch()
+            raise last_error
+        finally:
+            for task in tasks:
+                task.cancel()
@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from log import getlogger
+
+logger = getlogger()
+
+
+class ImageCache:
+    """
+    Content-addressed image cache keyed by normalized prompt
+    Parameters:
+        path: str, directory of image blobs and index
+        max_size: int, max total size of blobs in bytes
+    """
+
+    def __init__(self, path: str = "images/cache", max_size: int = 512 << 20) -> None:
+        self.path = path
+        self.max_size = max_size
+        self.index_path = os.path.join(path, "index.json")
+        os.makedirs(path, exist_ok=True)
+        # prompts: prompt -> {"hashes": [sha256]}
+        # blobs: sha256 -> {"size": int, "atime": float}
+        self.index = {"prompts": {}, "blobs": {}}
+        if os.path.exists(self.index_path):
+            try:
+                with open(self.index_path, "r", encoding="utf-8") as fp:
+                    self.index = json.load(fp)
+            except (OSError, ValueError) as e:
+                logger.warning(f"image cache index is broken, starting empty: {e}")
+
+    def normalize(self, prompt: str) -> str:
+        return " ".join(prompt.lower().split())
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.path, f"{digest}.jpeg")
+
+    def save(self) -> None:
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(self.index, fp)
+        os.replace(tmp_path, self.index_path)
+
+    # local blobs of the prompt, most recent first
+    def get_blobs(self, prompt: str) -> list:
+        entry = self.index["prompts"].get(self.normalize(prompt))
+        if entry is None:
+            return []
+        paths = []
+        for digest in reversed(entry["hashes"]):
+            path = self.blob_path(digest)
+            if digest in self.index["blobs"] and os.path.exists(path):
+                self.index["blobs"][digest]["atime"] = time.time()
+                paths.append(path)
+        if paths:
+            # keep lru order across restarts
+            self.save()
+        return paths
+
+    # move image into blob store, return blob path
+    def add_blob(self, prompt: str, filepath: str) -> str:
+        sha256 = hashlib.sha256()
+        with open(filepath, "rb") as fp:
+            for chunk in iter(lambda: fp.read(65536), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            os.remove(filepath)
+        else:
+            shutil.move(filepath, path)
+
+        self.index["blobs"][digest] = {
+            "size": os.path.getsize(path),
+            "atime": time.time(),
+        }
+        entry = self.index["prompts"].setdefault(self.normalize(prompt), {"hashes": []})
+        if digest not in entry["hashes"]:
+            entry["hashes"].append(digest)
+        self.evict()
+        self.save()
+        return path
+
+    # remove least recently used blobs until total size fits
+    def evict(self) -> None:
+        blobs = self.index["blobs"]
+        total = sum(blob["size"] for blob in blobs.values())
+        for digest in sorted(blobs, key=lambda digest: blobs[digest]["atime"]):
+            if total <= self.max_size:
+                break
+            total -= blobs.pop(digest)["size"]
+            try:
+                os.remove(self.blob_path(digest))
+            except OSError:
+                pass
+        for prompt, entry in list(self.index["prompts"].items()):
+            entry["hashes"] = [digest for digest in entry["hashes"] if digest in blobs]
+            if not entry["hashes"]:
+                del self.index["prompts"][prompt]
@@ -0,0 +1,153 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+from log import getlogger
+
+logger = getlogger()
+
+
+class APIKey:
+    """
+    State of a single api key
+    """
+
+    __slots__ = ["key", "in_flight", "remaining", "quarantined_until", "throttled"]
+
+    def __init__(self, key: str) -> None:
+        self.key = key
+        self.in_flight = 0
+        # remaining requests reported by x-ratelimit-remaining-requests
+        self.remaining: Optional[int] = None
+        self.quarantined_until = 0.0
+        self.throttled = 0
+
+
+def parse_reset(value: str) -> float:
+    """
+    Parse openai reset header like 1s, 6m0s, 20ms into seconds
+    """
+    seconds = 0.0
+    number = ""
+    index = 0
+    while index < len(value):
+        char = value[index]
+        if char.isdigit() or char == ".":
+            number += char
+        elif value.startswith("ms", index):
+            seconds += float(number or 0) / 1000
+            number = ""
+            index += 1
+        else:
+            seconds += float(number or 0) * {"h": 3600, "m": 60}.get(char, 1)
+            number = ""
+        index += 1
+    if number:
+        seconds += float(number)
+    return seconds
+
+
+class KeyPool:
+    """
+    Load balance requests across api keys
+    Parameters:
+        keys: list of api keys, may belong to different organizations
+        max_concurrency: int, in-flight requests allowed per key
+        quarantine: float, seconds a throttled key is skipped without reset header
+    """
+
+    def __init__(
+        self, keys: list, max_concurrency: int = 8, quarantine: float = 20
+    ) -> None:
+        if not keys:
+            raise ValueError("at least one api key must be provided")
+        self.keys = [APIKey(key) for key in keys]
+        self.max_concurrency = max_concurrency
+        self.quarantine = quarantine
+        self.condition = asyncio.Condition()
+
+    def _score(self, api_key: APIKey) -> tuple:
+        # fewer in-flight requests, then more remaining quota, then fewer 429s
+        remaining = api_key.remaining if api_key.remaining is not None else 1 << 30
+        return (api_key.in_flight, -remaining, api_key.throttled)
+
+    def _pick(self) -> Optional[APIKey]:
+        now = time.monotonic()
+        for api_key in self.keys:
+            # quota is reset once quarantine expires
+            if api_key.remaining == 0 and api_key.quarantined_until <= now:
+                api_key.remaining = None
+        candidates = [
+            api_key
+            for api_key in self.keys
+            if api_key.quarantined_until <= now
+            and api_key.in_flight < self.max_concurrency
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=self._score)
+
+    def _next_release(self) -> float:
+        now = time.monotonic()
+        waits = [
+            api_key.quarantined_until - now
+            for api_key in self.keys
+            if api_key.quarantined_until > now
+        ]
+        return min(waits) if waits else self.quarantine
+
+    async def get(self) -> APIKey:
+        """
+        Borrow the least loaded key, wait if every key is busy or throttled
+        """
+        async with self.condition:
+            while True:
+                api_key = self._pick()
+                if api_key is not None:
+                    break
+                try:
+                    await asyncio.wait_for(
+                        self.condition.wait(), timeout=self._next_release()
+                    )
+                except asyncio.TimeoutError:
+                    pass
+            api_key.in_flight += 1
+            return api_key
+
+    async def release(self, api_key: APIKey) -> None:
+        async with self.condition:
+            api_key.in_flight -= 1
+            self.condition.notify()
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[APIKey]:
+        api_key = await self.get()
+        try:
+            yield api_key
+        finally:
+            await self.release(api_key)
+
+    def update(self, api_key: APIKey, status: int, headers) -> None:
+        """
+        Track quota from response status and x-ratelimit-* headers
+        """
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is not None:
+            try:
+                api_key.remaining = int(remaining)
+            except ValueError:
+                pass
+        if status == 429 or api_key.remaining == 0:
+            reset = headers.get("x-ratelimit-reset-requests") or headers.get(
+                "retry-after"
+            )
+            try:
+                wait = parse_reset(reset) if reset else self.quarantine
+            except ValueError:
+                wait = self.quarantine
+            api_key.quarantined_until = time.monotonic() + max(wait, 1)
+            if status == 429:
+                api_key.throttled += 1
+                logger.warning(f"api key ...{api_key.key[-4:]} throttled for {wait}s")
+        elif status == 200:
+            api_key.throttled = max(api_key.throttled - 1, 0)
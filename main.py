@@ -1,48 +1,62 @@
 from bot import Bot
-import json
-import os
+from config import ConfigWatcher, load_config
+from worker import Ingestor
 import asyncio
+import signal
 
 
 async def main():
-    if os.path.exists("config.json"):
-        fp = open("config.json", "r", encoding="utf-8")
-        config = json.load(fp)
-
-        mattermost_bot = Bot(
-            server_url=config.get("server_url"),
-            access_token=config.get("access_token"),
-            login_id=config.get("login_id"),
-            password=config.get("password"),
-            username=config.get("username"),
-            openai_api_key=config.get("openai_api_key"),
-            openai_api_endpoint=config.get("openai_api_endpoint"),
-            bing_api_endpoint=config.get("bing_api_endpoint"),
-            bard_token=config.get("bard_token"),
-            bing_auth_cookie=config.get("bing_auth_cookie"),
-            port=config.get("port"),
-            timeout=config.get("timeout"),
-        )
-
-    else:
-        mattermost_bot = Bot(
-            server_url=os.environ.get("SERVER_URL"),
-            access_token=os.environ.get("ACCESS_TOKEN"),
-            login_id=os.environ.get("LOGIN_ID"),
-            password=os.environ.get("PASSWORD"),
-            username=os.environ.get("USERNAME"),
-            openai_api_key=os.environ.get("OPENAI_API_KEY"),
-            openai_api_endpoint=os.environ.get("OPENAI_API_ENDPOINT"),
-            bing_api_endpoint=os.environ.get("BING_API_ENDPOINT"),
-            bard_token=os.environ.get("BARD_TOKEN"),
-            bing_auth_cookie=os.environ.get("BING_AUTH_COOKIE"),
-            port=os.environ.get("PORT"),
-            timeout=os.environ.get("TIMEOUT"),
-        )
+    config = load_config()
+    workers = int(config.pop("workers") or 0)
+    if workers > 0:
+        await run_workers(config, workers)
+        return
+
+    mattermost_bot = Bot(**config)
 
     mattermost_bot.login()
 
-    await mattermost_bot.run()
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+
+    # reload config when config.json changes or on SIGHUP
+    watcher = ConfigWatcher("config.json", mattermost_bot.reload)
+    loop.add_signal_handler(signal.SIGHUP, watcher.trigger)
+
+    run_task = asyncio.create_task(mattermost_bot.run())
+    stop_task = asyncio.create_task(stop_event.wait())
+    watch_task = asyncio.create_task(watcher.watch())
+    await asyncio.wait([run_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+    # graceful shutdown on SIGTERM
+    watch_task.cancel()
+    await mattermost_bot.shutdown()
+    run_task.cancel()
+    stop_task.cancel()
+
+
+# websocket ingestor in this process, commands run in worker processes
+async def run_workers(config: dict, workers: int):
+    ingestor = Ingestor(config, workers)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, stop_event.set)
+    # workers reload config themselves, connection keys require restart
+    loop.add_signal_handler(signal.SIGHUP, ingestor.reload)
+
+    await ingestor.start()
+
+    run_task = asyncio.create_task(ingestor.run())
+    stop_task = asyncio.create_task(stop_event.wait())
+    await asyncio.wait([run_task, stop_task], return_when=asyncio.FIRST_COMPLETED)
+
+    await ingestor.shutdown()
+    run_task.cancel()
+    stop_task.cancel()
 
 
 if __name__ == "__main__":
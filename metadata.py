@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+from typing import Optional
+from mattermostdriver import Driver
+from log import getlogger
+
+logger = getlogger()
+
+
+class MetadataIndex:
+    """
+    Cached user/channel metadata
+    Parameters:
+        driver: Driver
+        ttl: int, seconds before a cached entry is fetched again
+    """
+
+    def __init__(self, driver: Driver, ttl: int = 600) -> None:
+        self.driver = driver
+        self.ttl = ttl
+        self.bot_user_id: Optional[str] = None
+        # id -> (expire_at, value)
+        self.channels: dict[str, tuple[float, str]] = {}
+        self.users: dict[str, tuple[float, dict]] = {}
+
+    # resolve bot's own user id once, must be called after login
+    def resolve_bot_user(self) -> str:
+        user = self.driver.users.get_user("me")
+        self.bot_user_id = user["id"]
+        self.set_user(user)
+        return self.bot_user_id
+
+    def set_channel_type(self, channel_id: str, channel_type: str) -> None:
+        self.channels[channel_id] = (time.monotonic() + self.ttl, channel_type)
+
+    def set_user(self, user: dict) -> None:
+        self.users[user["id"]] = (time.monotonic() + self.ttl, user)
+
+    def _lookup(self, cache: dict, key: str):
+        entry = cache.get(key)
+        if entry is None:
+            return None
+        expire_at, value = entry
+        if expire_at < time.monotonic():
+            del cache[key]
+            return None
+        return value
+
+    # channel type: O(public), P(private), D(direct), G(group)
+    async def get_channel_type(self, channel_id: str) -> str:
+        channel_type = self._lookup(self.channels, channel_id)
+        if channel_type is None:
+            channel = await asyncio.to_thread(
+                self.driver.channels.get_channel, channel_id
+            )
+            channel_type = channel["type"]
+            self.set_channel_type(channel_id, channel_type)
+        return channel_type
+
+    async def get_user(self, user_id: str) -> dict:
+        user = self._lookup(self.users, user_id)
+        if user is None:
+            user = await asyncio.to_thread(self.driver.users.get_user, user_id)
+            self.set_user(user)
+        return user
+
+    # keep cache fresh from websocket events, no REST call involved
+    def handle_event(self, response: dict) -> None:
+        event_type = response.get("event")
+        data = response.get("data", {})
+        broadcast = response.get("broadcast", {})
+        try:
+            if event_type == "posted":
+                post = json.loads(data["post"])
+                if "channel_type" in data:
+                    self.set_channel_type(post["channel_id"], data["channel_type"])
+            elif event_type == "user_updated":
+                self.set_user(data["user"])
+            elif event_type == "channel_updated":
+                channel = json.loads(data["channel"])
+                self.set_channel_type(channel["id"], channel["type"])
+            elif event_type == "channel_converted":
+                self.channels.pop(data["channel_id"], None)
+            elif event_type == "channel_deleted":
+                self.channels.pop(data.get("channel_id", ""), None)
+            elif event_type == "direct_added":
+                self.set_channel_type(broadcast["channel_id"], "D")
+            elif event_type == "group_added":
+                self.set_channel_type(broadcast["channel_id"], "G")
+        except (KeyError, TypeError, ValueError) as e:
+            logger.warning(f"failed to update metadata from {event_type}: {e}")
+
+    # check whether a posted event mentions the bot
+    def is_mentioned(self, data: dict) -> bool:
+        if self.bot_user_id is None or "mentions" not in data:
+            return False
+        try:
+            mentions = json.loads(data["mentions"])
+        except ValueError:
+            return False
+        return self.bot_user_id in mentions
@@ -0,0 +1,141 @@
+import asyncio
+import time
+from typing import Optional
+import requests
+from mattermostdriver import Driver
+from log import getlogger
+
+logger = getlogger()
+
+
+class Poster:
+    """
+    Outbound posting with an adaptive token bucket driven by
+    Mattermost's X-RateLimit-* headers
+    Parameters:
+        driver: Driver
+        rate: float, initial requests per second
+        max_post_size: int, max characters of a single post
+        max_retry: int, retries on 429 before giving up
+    """
+
+    def __init__(
+        self,
+        driver: Driver,
+        rate: float = 10,
+        max_post_size: int = 16383,
+        max_retry: int = 5,
+    ) -> None:
+        self.driver = driver
+        self.rate = rate
+        self.capacity = rate
+        self.tokens = rate
+        self.max_post_size = max_post_size
+        self.max_retry = max_retry
+        self.updated_at = time.monotonic()
+        # no request is sent before this time
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    # wait for a token, requests are served in arrival order
+    async def acquire(self) -> None:
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if self.blocked_until > now:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+    # adapt bucket to server side limit
+    def update(self, headers) -> None:
+        try:
+            limit = headers.get("X-RateLimit-Limit")
+            remaining = headers.get("X-RateLimit-Remaining")
+            reset = headers.get("X-RateLimit-Reset")
+            if limit is not None and float(limit) > 0:
+                self.rate = float(limit)
+                self.capacity = float(limit)
+            if remaining is not None:
+                self._refill()
+                self.tokens = min(self.tokens, float(remaining))
+                if float(remaining) <= 0 and reset is not None:
+                    self.blocked_until = time.monotonic() + float(reset)
+        except ValueError:
+            logger.warning(f"invalid rate limit headers: {dict(headers)}")
+
+    async def request(self, method: str, endpoint: str, **kwargs) -> dict:
+        retry = 0
+        while True:
+            await self.acquire()
+            try:
+                response = await asyncio.to_thread(
+                    self.driver.client.make_request, method, endpoint, **kwargs
+                )
+            except requests.HTTPError as e:
+                if e.response is None or e.response.status_code != 429:
+                    raise
+                self.update(e.response.headers)
+                retry += 1
+                if retry > self.max_retry:
+                    raise
+                # make sure we back off even without headers
+                self.blocked_until = max(
+                    self.blocked_until, time.monotonic() + 2**retry / 2
+                )
+                logger.warning(f"rate limited by mattermost, retry {retry}")
+                continue
+            self.update(response.headers)
+            return response.json()
+
+    # split long message at the server's max post size
+    def split_message(self, message: str) -> list[str]:
+        chunks = []
+        while len(message) > self.max_post_size:
+            # prefer to break at line end
+            index = message.rfind("\n", 0, self.max_post_size)
+            if index <= 0:
+                index = self.max_post_size
+            chunks.append(message[:index])
+            message = message[index:].lstrip("\n")
+        chunks.append(message)
+        return chunks
+
+    async def create_post(
+        self, channel_id: str, message: str, file_ids: Optional[list] = None
+    ) -> dict:
+        chunks = self.split_message(message)
+        for index, chunk in enumerate(chunks):
+            options = {
+                "channel_id": channel_id,
+                "message": chunk,
+            }
+            # attach files to the last post
+            if file_ids and index == len(chunks) - 1:
+                options["file_ids"] = file_ids
+            post = await self.request("post", "/posts", options=options)
+        return post
+
+    async def upload_file(self, channel_id: str, files: dict) -> dict:
+        return await self.request(
+            "post", "/files", data={"channel_id": channel_id}, files=files
+        )
+
+    # replace message of an existing post, used to stream answers into one post
+    async def update_post(self, post_id: str, message: str) -> dict:
+        return await self.request(
+            "put",
+            f"/posts/{post_id}/patch",
+            options={"message": message[: self.max_post_size]},
+        )
@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+from log import getlogger
+
+logger = getlogger()
+
+
+class UserBudget:
+    """
+    Per-user sliding window request and token budget
+    Parameters:
+        max_requests: int, None means unlimited
+        max_tokens: int, None means unlimited
+        window: int, window size in seconds
+    """
+
+    def __init__(
+        self,
+        max_requests: Optional[int] = None,
+        max_tokens: Optional[int] = None,
+        window: int = 3600,
+    ) -> None:
+        self.max_requests = max_requests
+        self.max_tokens = max_tokens
+        self.window = window
+        # user_id -> deque of (timestamp, tokens)
+        self.usage: dict[str, deque] = {}
+
+    def _expire(self, user_id: str) -> deque:
+        records = self.usage.setdefault(user_id, deque())
+        now = time.monotonic()
+        while records and records[0][0] + self.window < now:
+            records.popleft()
+        return records
+
+    # return reject reason or None if user is within budget
+    def check(self, user_id: str) -> Optional[str]:
+        records = self._expire(user_id)
+        if self.max_requests is not None and len(records) >= self.max_requests:
+            return "request budget"
+        if self.max_tokens is not None:
+            if sum(tokens for _, tokens in records) >= self.max_tokens:
+                return "token budget"
+        return None
+
+    # seconds until the oldest record leaves the window
+    def retry_after(self, user_id: str) -> int:
+        records = self._expire(user_id)
+        if not records:
+            return 0
+        return max(int(records[0][0] + self.window - time.monotonic()), 1)
+
+    def charge_request(self, user_id: str) -> list:
+        record = [time.monotonic(), 0]
+        self._expire(user_id).append(record)
+        return record
+
+    def charge_tokens(self, record: list, tokens: int) -> None:
+        record[1] += tokens
+
+
+class FairScheduler:
+    """
+    Deficit round-robin scheduler across users
+    Parameters:
+        concurrency: int, number of jobs running at the same time
+        quantum: int, cost credited to each user per round
+    """
+
+    def __init__(self, concurrency: int = 4, quantum: int = 1) -> None:
+        self.concurrency = concurrency
+        self.quantum = quantum
+        # user_id -> deque of (cost, job)
+        self.queues: dict[str, deque] = {}
+        self.deficits: dict[str, int] = {}
+        # users with pending jobs in round-robin order
+        self.active: deque = deque()
+        self.wakeup = asyncio.Event()
+        self.workers: list[asyncio.Task] = []
+        self.running = 0
+        # set when no job is pending or running
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+    def pending(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def submit(
+        self, user_id: str, job: Callable[[], Awaitable[None]], cost: int = 1
+    ) -> None:
+        queue = self.queues.setdefault(user_id, deque())
+        if not queue:
+            self.active.append(user_id)
+            self.deficits[user_id] = 0
+        queue.append((cost, job))
+        self.idle.clear()
+        self.wakeup.set()
+
+    def _next_job(self) -> Optional[Callable[[], Awaitable[None]]]:
+        while self.active:
+            user_id = self.active[0]
+            queue = self.queues[user_id]
+            cost, job = queue[0]
+            if cost <= self.deficits[user_id]:
+                queue.popleft()
+                self.deficits[user_id] -= cost
+                if not queue:
+                    # idle users don't keep credit
+                    self.active.popleft()
+                    del self.queues[user_id]
+                    del self.deficits[user_id]
+                return job
+            # not enough credit, move to next user
+            self.deficits[user_id] += self.quantum
+            self.active.rotate(-1)
+        return None
+
+    async def worker(self) -> None:
+        while True:
+            # shrink pool after concurrency is lowered
+            if len(self.workers) > self.concurrency:
+                self.workers.remove(asyncio.current_task())
+                return
+            job = self._next_job()
+            if job is None:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            self.running += 1
+            try:
+                await job()
+            except Exception as e:
+                logger.error(e, exc_info=True)
+            finally:
+                self.running -= 1
+                if self.running == 0 and not self.active:
+                    self.idle.set()
+
+    def start(self) -> None:
+        if not self.workers:
+            self.workers = [
+                asyncio.create_task(self.worker()) for _ in range(self.concurrency)
+            ]
+
+    def resize(self, concurrency: int) -> None:
+        self.concurrency = concurrency
+        if self.workers:
+            while len(self.workers) < concurrency:
+                self.workers.append(asyncio.create_task(self.worker()))
+            # idle workers check pool size on wakeup
+            self.wakeup.set()
+
+    # wait for pending and running jobs, then stop workers
+    async def drain(self, timeout: float) -> None:
+        try:
+            await asyncio.wait_for(self.idle.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f"{self.pending()} pending and {self.running} running jobs "
+                + "are cancelled after drain timeout"
+            )
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
@@ -0,0 +1,109 @@
+import asyncio
+import fcntl
+import hashlib
+import os
+import time
+import zlib
+from typing import Optional
+from log import getlogger
+
+logger = getlogger()
+
+
+class ShardRouter:
+    """
+    Decide which replica handles a channel
+    Parameters:
+        replica_index: int, index of this replica, starts from 0
+        replica_count: int, number of replicas
+        shard_dir: str, shared directory for liveness locks, enables
+            rendezvous hashing so shards of a failed replica move to the others
+        check_interval: float, seconds live replicas are cached
+    """
+
+    def __init__(
+        self,
+        replica_index: int = 0,
+        replica_count: int = 1,
+        shard_dir: Optional[str] = None,
+        check_interval: float = 2,
+    ) -> None:
+        if not 0 <= replica_index < replica_count:
+            raise ValueError("replica_index must be in [0, replica_count)")
+        self.replica_index = replica_index
+        self.replica_count = replica_count
+        self.shard_dir = shard_dir
+        self.check_interval = check_interval
+        self.live: list = list(range(replica_count))
+        self.checked_at = 0.0
+        self.lock_fp = None
+
+    def lock_path(self, index: int) -> str:
+        return os.path.join(self.shard_dir, f"replica-{index}.lock")
+
+    # hold own lock while alive, it is released by the os when process dies
+    async def start(self) -> None:
+        if self.shard_dir is None or self.replica_count == 1:
+            return
+        os.makedirs(self.shard_dir, exist_ok=True)
+        self.lock_fp = open(self.lock_path(self.replica_index), "a")
+        waiting = False
+        while True:
+            try:
+                fcntl.flock(self.lock_fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                # held briefly by a liveness check, or by a previous process
+                # with the same index that is still shutting down
+                if not waiting:
+                    logger.warning(
+                        f"waiting for lock of replica {self.replica_index}, "
+                        + "is another process running with the same index?"
+                    )
+                    waiting = True
+                await asyncio.sleep(self.check_interval)
+        logger.info(f"replica {self.replica_index}/{self.replica_count} started")
+
+    def stop(self) -> None:
+        if self.lock_fp is not None:
+            fcntl.flock(self.lock_fp, fcntl.LOCK_UN)
+            self.lock_fp.close()
+            self.lock_fp = None
+
+    def is_alive(self, index: int) -> bool:
+        if index == self.replica_index:
+            return True
+        try:
+            with open(self.lock_path(index), "a") as fp:
+                fcntl.flock(fp, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                fcntl.flock(fp, fcntl.LOCK_UN)
+            return False
+        except BlockingIOError:
+            return True
+
+    def live_replicas(self) -> list:
+        now = time.monotonic()
+        if now - self.checked_at > self.check_interval:
+            live = [
+                index for index in range(self.replica_count) if self.is_alive(index)
+            ]
+            if live != self.live:
+                logger.warning(f"live replicas changed: {self.live} -> {live}")
+            self.live = live
+            self.checked_at = now
+        return self.live
+
+    def owner(self, channel_id: str) -> int:
+        if self.shard_dir is None:
+            # crc32 is stable across processes unlike hash()
+            return zlib.crc32(channel_id.encode()) % self.replica_count
+        # rendezvous hashing, highest score among live replicas wins
+        return max(
+            self.live_replicas(),
+            key=lambda index: hashlib.sha1(f"{index}:{channel_id}".encode()).digest(),
+        )
+
+    def owns(self, channel_id: str) -> bool:
+        if self.replica_count == 1:
+            return True
+        return self.owner(channel_id) == self.replica_index
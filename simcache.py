@@ -0,0 +1,167 @@
+import re
+from collections import Counter, OrderedDict
+from typing import Optional
+from log import getlogger
+
+logger = getlogger()
+
+MASK = (1 << 64) - 1
+
+
+class SimilarityCache:
+    """
+    Near-duplicate prompt cache backed by a local MinHash/LSH index
+    Parameters:
+        threshold: float, minimum estimated jaccard similarity for a hit
+        max_size: int, max cached prompts, least recently used is evicted
+        num_perm: int, number of minhash permutations
+        bands: int, number of lsh bands, must divide num_perm
+        shingle_size: int, characters per shingle
+        max_candidates: int, most lsh candidates compared on a lookup
+        name: str, used in metrics log
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        max_size: int = 1000,
+        num_perm: int = 64,
+        bands: int = 16,
+        shingle_size: int = 4,
+        max_candidates: int = 16,
+        name: str = "similarity",
+    ) -> None:
+        if num_perm % bands != 0:
+            raise ValueError("bands must divide num_perm")
+        self.threshold = threshold
+        self.max_size = max_size
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.max_candidates = max_candidates
+        self.name = name
+        # key -> (signature, response)
+        self.entries: OrderedDict[str, tuple[tuple, str]] = OrderedDict()
+        # (band index, band hash) -> set of keys
+        self.buckets: dict[tuple, set] = {}
+        self.hits = 0
+        self.misses = 0
+
+    # lowercase, strip punctuation and collapse whitespace
+    def normalize(self, prompt: str) -> str:
+        prompt = re.sub(r"[^\w\s]", " ", prompt.lower())
+        return " ".join(prompt.split())
+
+    def shingles(self, text: str) -> set:
+        if len(text) <= self.shingle_size:
+            return {text}
+        return {
+            text[i : i + self.shingle_size]
+            for i in range(len(text) - self.shingle_size + 1)
+        }
+
+    # one permutation hashing, a single pass puts each shingle hash into one
+    # of num_perm bins and keeps the minimum per bin
+    def signature(self, text: str) -> tuple:
+        bins: list = [None] * self.num_perm
+        for shingle in self.shingles(text):
+            # str hash is salted per process, signatures are never persisted
+            value = hash(shingle) & MASK
+            index = value % self.num_perm
+            if bins[index] is None or value < bins[index]:
+                bins[index] = value
+        # empty bins borrow the next filled bin, tagged with the distance
+        signature = list(bins)
+        for index, value in enumerate(bins):
+            distance = 0
+            while value is None:
+                distance += 1
+                value = bins[(index + distance) % self.num_perm]
+            signature[index] = value + (distance << 64)
+        return tuple(signature)
+
+    def band_keys(self, signature: tuple) -> list:
+        return [
+            (band, hash(signature[band * self.rows : (band + 1) * self.rows]))
+            for band in range(self.bands)
+        ]
+
+    def similarity(self, sig1: tuple, sig2: tuple) -> float:
+        return sum(1 for a, b in zip(sig1, sig2) if a == b) / self.num_perm
+
+    def get(self, prompt: str) -> Optional[str]:
+        response = self._get(prompt)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        # report metrics every 100 lookups
+        if (self.hits + self.misses) % 100 == 0:
+            logger.info(f"{self.name} cache: {self.stats()}")
+        return response
+
+    def _get(self, prompt: str) -> Optional[str]:
+        text = self.normalize(prompt)
+        entry = self.entries.get(text)
+        if entry is not None:
+            self.entries.move_to_end(text)
+            return entry[1]
+
+        signature = self.signature(text)
+        candidates: Counter = Counter()
+        for band_key in self.band_keys(signature):
+            candidates.update(self.buckets.get(band_key, ()))
+
+        # prompts sharing more bands are more similar, compare those only
+        best_key, best_score = None, 0.0
+        for key, _ in candidates.most_common(self.max_candidates):
+            score = self.similarity(signature, self.entries[key][0])
+            if score > best_score:
+                best_key, best_score = key, score
+
+        if best_key is not None and best_score >= self.threshold:
+            self.entries.move_to_end(best_key)
+            return self.entries[best_key][1]
+
+        return None
+
+    def put(self, prompt: str, response: str) -> None:
+        text = self.normalize(prompt)
+        if text in self.entries:
+            self._remove(text)
+        signature = self.signature(text)
+        self.entries[text] = (signature, response)
+        for band_key in self.band_keys(signature):
+            self.buckets.setdefault(band_key, set()).add(text)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, key: str) -> None:
+        signature, _ = self.entries.pop(key)
+        for band_key in self.band_keys(signature):
+            bucket = self.buckets.get(band_key)
+            if bucket is not None:
+                bucket.discard(key)
+                if not bucket:
+                    del self.buckets[band_key]
+
+    # (prompt, response) pairs, least recently used first
+    def dump(self) -> list:
+        return [[key, response] for key, (_, response) in self.entries.items()]
+
+    def load(self, entries: list) -> None:
+        for prompt, response in entries:
+            self.put(prompt, response)
+
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hit_rate(), 4),
+        }
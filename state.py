@@ -0,0 +1,33 @@
+import json
+import os
+from log import getlogger
+
+logger = getlogger()
+
+
+class StateStore:
+    """
+    Conversation state handoff between bot processes
+    Parameters:
+        path: str, json file the state is written to
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+
+    def load(self) -> dict:
+        if not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as fp:
+                return json.load(fp)
+        except (OSError, ValueError) as e:
+            logger.warning(f"failed to load state from {self.path}: {e}")
+            return {}
+
+    # write to a temp file first so a crash never leaves a partial state
+    def save(self, state: dict) -> None:
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as fp:
+            json.dump(state, fp, ensure_ascii=False)
+        os.replace(tmp_path, self.path)
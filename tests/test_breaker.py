@@ -0,0 +1,41 @@
+import asyncio
+
+from breaker import CircuitBreaker
+from deadline import set_deadline
+
+
+async def hang() -> None:
+    await asyncio.Event().wait()
+
+
+async def hanging_requests(breaker: CircuitBreaker, count: int) -> None:
+    for _ in range(count):
+        set_deadline(0.01)
+        try:
+            await breaker.call(hang)
+        except asyncio.TimeoutError:
+            pass
+
+
+def test_hanging_backend_trips_at_deadline():
+    breaker = CircuitBreaker("openai", min_calls=5)
+
+    asyncio.run(hanging_requests(breaker, 5))
+
+    assert breaker.state == "open"
+
+
+def test_user_cancel_is_not_recorded():
+    breaker = CircuitBreaker("openai")
+
+    async def request() -> None:
+        set_deadline(10)
+        task = asyncio.create_task(breaker.call(hang))
+        await asyncio.sleep(0.01)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+    asyncio.run(request())
+
+    assert breaker.state == "closed"
+    assert not breaker.results
@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import httpx
+
+from v3 import SUMMARY_PREFIX, Chatbot
+
+API_URL = "http://openai-stub.local/v1/chat/completions"
+
+
+class WordEncoding:
+    """
+    Offline stand-in for tiktoken, one token per word
+    """
+
+    def encode(self, text: str) -> list:
+        return text.split()
+
+
+def add_turn(chatbot: Chatbot, text: str, role: str = "user") -> None:
+    chatbot.add_to_conversation(text, role, convo_id="channel")
+
+
+def make_chatbot(monkeypatch, on_request=None) -> tuple:
+    """
+    Chatbot talking to a local OpenAI stub, return (chatbot, request bodies)
+    """
+    monkeypatch.setattr(Chatbot, "get_encoding", lambda self: WordEncoding())
+    chatbot = Chatbot(
+        api_key="sk-test",
+        api_url=API_URL,
+        compact_threshold=400,
+        compact_target=200,
+    )
+    bodies = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        bodies.append(json.loads(request.content))
+        if on_request is not None:
+            on_request(chatbot)
+        return httpx.Response(
+            200, json={"choices": [{"message": {"content": "short summary"}}]}
+        )
+
+    chatbot.aclient = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    chatbot.reset("channel")
+    for turn in range(20):
+        add_turn(chatbot, f"user message number {turn} " * 2)
+        add_turn(chatbot, f"assistant answer {turn} " * 2, "assistant")
+    return chatbot, bodies
+
+
+def contents(chatbot: Chatbot) -> list:
+    return [message.content for message in chatbot.conversation["channel"]]
+
+
+def test_compaction_replaces_older_turns(monkeypatch):
+    chatbot, bodies = make_chatbot(monkeypatch)
+    assert chatbot.needs_compaction("channel")
+
+    assert asyncio.run(chatbot.compact_conversation("channel"))
+
+    conversation = chatbot.conversation["channel"]
+    assert conversation[0].content == chatbot.system_prompt
+    assert conversation[1].content == SUMMARY_PREFIX + "short summary"
+    assert conversation[-1].content == "assistant answer 19 " * 2
+    assert chatbot.get_token_count("channel") <= 200
+    # older turns were sent to the stub, newest turns stayed verbatim
+    transcript = bodies[0]["messages"][1]["content"]
+    assert "user message number 0" in transcript
+    assert "assistant answer 19" not in transcript
+
+
+def test_rolling_summary_is_folded_into_next_summary(monkeypatch):
+    chatbot, bodies = make_chatbot(monkeypatch)
+    asyncio.run(chatbot.compact_conversation("channel"))
+    for turn in range(20, 40):
+        add_turn(chatbot, f"user message number {turn} " * 2)
+
+    assert asyncio.run(chatbot.compact_conversation("channel"))
+
+    assert bodies[1]["messages"][1]["content"].startswith(SUMMARY_PREFIX)
+    summaries = [content for content in contents(chatbot) if SUMMARY_PREFIX in content]
+    assert len(summaries) == 1
+
+
+def test_summary_discarded_when_truncated_meanwhile(monkeypatch):
+    # __truncate_conversation pops in place while the summary is requested
+    chatbot, _ = make_chatbot(
+        monkeypatch, on_request=lambda bot: bot.conversation["channel"].pop(1)
+    )
+    before = contents(chatbot)
+
+    assert not asyncio.run(chatbot.compact_conversation("channel"))
+
+    assert contents(chatbot) == before[:1] + before[2:]
+
+
+def test_turns_appended_meanwhile_are_kept(monkeypatch):
+    chatbot, _ = make_chatbot(
+        monkeypatch,
+        on_request=lambda bot: add_turn(bot, "late turn"),
+    )
+
+    assert asyncio.run(chatbot.compact_conversation("channel"))
+
+    assert contents(chatbot)[1] == SUMMARY_PREFIX + "short summary"
+    assert contents(chatbot)[-1] == "late turn"
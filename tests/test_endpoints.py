@@ -0,0 +1,36 @@
+import asyncio
+
+import pytest
+
+from endpoints import ClientError, EndpointPool, status_error
+
+
+def failing_attempt(status: int, calls: list):
+    async def attempt(endpoint: str) -> str:
+        calls.append(endpoint)
+        raise status_error(status, "error")
+
+    return attempt
+
+
+def test_client_error_is_raised_without_failover():
+    pool = EndpointPool(["a", "b"])
+    calls: list = []
+
+    with pytest.raises(ClientError):
+        asyncio.run(pool.request(failing_attempt(400, calls)))
+
+    assert len(calls) == 1
+    assert pool.health == {"a": 1.0, "b": 1.0}
+
+
+@pytest.mark.parametrize("status", [429, 503])
+def test_server_error_fails_over_and_lowers_health(status):
+    pool = EndpointPool(["a", "b"])
+    calls: list = []
+
+    with pytest.raises(Exception, match=str(status)):
+        asyncio.run(pool.request(failing_attempt(status, calls)))
+
+    assert sorted(calls) == ["a", "b"]
+    assert pool.health == {"a": 0.8, "b": 0.8}
@@ -4,10 +4,69 @@ Code derived from: https://github.com/acheong08/ChatGPT/blob/main/src/revChatGPT
 
 import json
 import os
-from typing import AsyncGenerator
+import sys
+import time
+from typing import AsyncGenerator, Union
 import httpx
 import requests
 import tiktoken
+from config import parse_list
+from endpoints import EndpointPool, status_error
+from keypool import KeyPool
+
+# content prefix of the rolling summary message
+SUMMARY_PREFIX = "Summary of the earlier conversation:\n"
+
+
+def engine_limits(engine: str) -> tuple[int, int]:
+    """
+    Get (max_tokens, truncate_limit) of an engine
+    """
+    if engine.startswith("gpt-4-32k"):
+        return 31000, 30500
+    if engine.startswith("gpt-4"):
+        return 7000, 6500
+    if engine.startswith("gpt-3.5-turbo-16k"):
+        return 15000, 14500
+    return 4000, 3500
+
+
+class Message:
+    """
+    Compact conversation message
+    Token count and json fragment are computed once and cached
+    """
+
+    __slots__ = ["role", "content", "_tokens", "_fragment"]
+
+    def __init__(self, role: str, content: str) -> None:
+        self.role: str = sys.intern(role)
+        self.content: str = content
+        self._tokens: int = None
+        self._fragment: bytes = None
+
+    def token_count(self, encoding: tiktoken.Encoding) -> int:
+        """
+        Get token count of the message
+        """
+        if self._tokens is None:
+            # every message follows <im_start>{role/name}\n{content}<im_end>\n
+            self._tokens = 5 + len(encoding.encode(self.role))
+            self._tokens += len(encoding.encode(self.content))
+        return self._tokens
+
+    def fragment(self) -> bytes:
+        """
+        Get pre-encoded json of the message
+        """
+        if self._fragment is None:
+            self._fragment = json.dumps(
+                {"role": self.role, "content": self.content}
+            ).encode("utf-8")
+        return self._fragment
+
+    def to_dict(self) -> dict:
+        return {"role": self.role, "content": self.content}
 
 
 class Chatbot:
@@ -28,25 +87,47 @@ class Chatbot:
         frequency_penalty: float = 0.0,
         reply_count: int = 1,
         system_prompt: str = "You are ChatGPT, a large language model trained by OpenAI. Respond conversationally",
+        api_url: Union[str, list] = None,
+        key_pool: KeyPool = None,
+        compact_threshold: int = None,
+        compact_target: int = None,
+        engines: Union[str, list] = None,
     ) -> None:
         """
         Initialize Chatbot with API key (from https://platform.openai.com/account/api-keys)
         """
         self.engine: str = engine
         self.api_key: str = api_key
+        self.key_pool: KeyPool = key_pool or KeyPool([api_key])
         self.system_prompt: str = system_prompt
-        self.max_tokens: int = max_tokens or (
-            31000 if engine == "gpt-4-32k" else 7000 if engine == "gpt-4" else 4000
-        )
-        self.truncate_limit: int = (
-            30500 if engine == "gpt-4-32k" else 6500 if engine == "gpt-4" else 3500
+        self.max_tokens: int = max_tokens or engine_limits(engine)[0]
+        self.truncate_limit: int = engine_limits(engine)[1]
+        # engines routed by conversation size, smallest context window first
+        engines = parse_list(engines or os.environ.get("GPT_ENGINES")) or [engine]
+        self.engines: list[str] = sorted(
+            set(engines),
+            key=lambda name: self.get_limits(name)[1],
         )
+        # engine -> (moving average of seconds to first token, samples, updated at)
+        self.latency: dict[str, tuple[float, int, float]] = {}
+        # latency only steers routing after enough fresh samples
+        self.min_latency_samples: int = 5
+        # a skipped engine gets a probe request once its samples are this old
+        self.latency_ttl: float = 60
+        # older turns are summarized once a conversation exceeds the threshold
+        self.compact_threshold: int = compact_threshold
+        self.compact_target: int = compact_target
+        self.compacting: set[str] = set()
         self.temperature: float = temperature
         self.top_p: float = top_p
         self.presence_penalty: float = presence_penalty
         self.frequency_penalty: float = frequency_penalty
         self.reply_count: int = reply_count
         self.timeout: float = timeout
+        self.endpoints = EndpointPool(
+            parse_list(api_url or os.environ.get("API_URL"))
+            or ["https://api.openai.com/v1/chat/completions"]
+        )
         self.proxy = proxy
         self.session = requests.Session()
         self.session.proxies.update(
@@ -73,12 +154,9 @@ class Chatbot:
                 timeout=timeout,
             )
 
-        self.conversation: dict[str, list[dict]] = {
+        self.conversation: dict[str, list[Message]] = {
             "default": [
-                {
-                    "role": "system",
-                    "content": system_prompt,
-                },
+                Message("system", system_prompt),
             ],
         }
 
@@ -91,15 +169,16 @@ class Chatbot:
         """
         Add a message to the conversation
         """
-        self.conversation[convo_id].append({"role": role, "content": message})
+        self.conversation[convo_id].append(Message(role, message))
 
     def __truncate_conversation(self, convo_id: str = "default") -> None:
         """
-        Truncate the conversation
+        Truncate the conversation to the largest routed engine
         """
+        truncate_limit = self.get_limits(self.engines[-1])[1]
         while True:
             if (
-                self.get_token_count(convo_id) > self.truncate_limit
+                self.get_token_count(convo_id) > truncate_limit
                 and len(self.conversation[convo_id]) > 1
             ):
                 # Don't remove the first message
@@ -107,13 +186,166 @@ class Chatbot:
             else:
                 break
 
-    def get_token_count(self, convo_id: str = "default") -> int:
+    def get_limits(self, engine: str) -> tuple[int, int]:
         """
-        Get token count
+        Get (max_tokens, truncate_limit), max_tokens option applies to engine
+        """
+        if engine == self.engine:
+            return self.max_tokens, self.truncate_limit
+        return engine_limits(engine)
+
+    def select_engine(self, tokens: int) -> str:
+        """
+        Route by token count, the smallest engine that fits wins unless it is
+        observed to be much slower than a larger one
+        """
+        candidates = [
+            engine for engine in self.engines if self.get_limits(engine)[1] >= tokens
+        ] or self.engines[-1:]
+        selected = candidates[0]
+        for engine in candidates[1:]:
+            slower = self.fresh_latency(selected)
+            faster = self.fresh_latency(engine)
+            if slower is None or faster is None or slower <= 2 * faster:
+                # stale or few samples, route to the smaller engine as a probe
+                break
+            selected = engine
+        return selected
+
+    def fresh_latency(self, engine: str) -> Union[float, None]:
+        """
+        Get average time to first token, None if samples are few or stale
+        """
+        if engine not in self.latency:
+            return None
+        average, samples, updated_at = self.latency[engine]
+        if samples < self.min_latency_samples:
+            return None
+        if time.monotonic() - updated_at > self.latency_ttl:
+            return None
+        return average
+
+    def record_latency(self, engine: str, seconds: float) -> None:
+        """
+        Update moving average of time to first token
+        """
+        if engine in self.latency:
+            average, samples, _ = self.latency[engine]
+            average = 0.8 * average + 0.2 * seconds
+        else:
+            average, samples = seconds, 0
+        self.latency[engine] = (average, samples + 1, time.monotonic())
+
+    def needs_compaction(self, convo_id: str = "default") -> bool:
+        """
+        Check whether the conversation should be summarized
+        """
+        return (
+            self.compact_threshold is not None
+            and convo_id in self.conversation
+            and convo_id not in self.compacting
+            and self.get_token_count(convo_id) > self.compact_threshold
+        )
+
+    async def compact_conversation(self, convo_id: str = "default", **kwargs) -> bool:
+        """
+        Replace older turns with a rolling summary, return whether compacted
+        """
+        if not self.needs_compaction(convo_id):
+            return False
+        encoding = self.get_encoding()
+        # snapshot, the live list is truncated in place by concurrent asks
+        messages = list(self.conversation[convo_id])
+        target = self.compact_target or self.compact_threshold // 2
+        summary_tokens = max(target // 4, 64)
+        # keep recent turns verbatim within the target size
+        budget = target - summary_tokens - messages[0].token_count(encoding)
+        split = len(messages)
+        while split > 2 and messages[split - 1].token_count(encoding) <= budget:
+            budget -= messages[split - 1].token_count(encoding)
+            split -= 1
+        older = messages[1:split]
+        if not older:
+            return False
+
+        self.compacting.add(convo_id)
+        try:
+            summary = await self.summarize(older, summary_tokens, **kwargs)
+        finally:
+            self.compacting.discard(convo_id)
+
+        # discard summary if summarized or kept turns were reset or truncated,
+        # turns appended meanwhile are kept
+        current = self.conversation.get(convo_id)
+        if current is None or len(current) < len(messages):
+            return False
+        if any(a is not b for a, b in zip(current, messages)):
+            return False
+        self.conversation[convo_id] = [
+            current[0],
+            Message("system", SUMMARY_PREFIX + summary),
+            *current[split:],
+        ]
+        return True
+
+    async def summarize(self, messages: list, max_tokens: int, **kwargs) -> str:
+        """
+        Summarize messages with a single non-streaming request
+        """
+        transcript = "\n\n".join(
+            message.content
+            if message.content.startswith(SUMMARY_PREFIX)
+            else f"{message.role}: {message.content}"
+            for message in messages
+        )
+        tokens = max_tokens + sum(
+            message.token_count(self.get_encoding()) for message in messages
+        )
+        body = json.dumps(
+            {
+                "model": self.select_engine(tokens),
+                "temperature": 0,
+                "max_tokens": max_tokens,
+                "messages": [
+                    {
+                        "role": "system",
+                        "content": "Summarize the conversation below concisely. "
+                        + "Keep facts, names, decisions and open questions "
+                        + "needed to continue it.",
+                    },
+                    {"role": "user", "content": transcript},
+                ],
+            }
+        ).encode("utf-8")
+
+        async def attempt(endpoint: str) -> str:
+            async with self.key_pool.acquire() as api_key:
+                response = await self.aclient.post(
+                    endpoint,
+                    headers={
+                        "Authorization": f"Bearer {api_key.key}",
+                        "Content-Type": "application/json",
+                    },
+                    content=body,
+                    timeout=kwargs.get("timeout", self.timeout),
+                )
+                self.key_pool.update(
+                    api_key, response.status_code, response.headers
+                )
+            if response.status_code != 200:
+                raise status_error(response.status_code, response.text)
+            return response.json()["choices"][0]["message"]["content"].strip()
+
+        return await self.endpoints.request(attempt)
+
+    def get_encoding(self) -> tiktoken.Encoding:
+        """
+        Get tiktoken encoding of current engine
         """
         if self.engine not in [
             "gpt-3.5-turbo",
             "gpt-3.5-turbo-0301",
+            "gpt-3.5-turbo-16k",
             "gpt-4",
             "gpt-4-0314",
             "gpt-4-32k",
@@ -123,47 +355,47 @@ class Chatbot:
 
         tiktoken.model.MODEL_TO_ENCODING["gpt-4"] = "cl100k_base"
 
-        encoding = tiktoken.encoding_for_model(self.engine)
+        return tiktoken.encoding_for_model(self.engine)
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Count tokens of a plain text
+        """
+        return len(self.get_encoding().encode(text))
+
+    def get_token_count(self, convo_id: str = "default") -> int:
+        """
+        Get token count
+        """
+        encoding = self.get_encoding()
 
         num_tokens = 0
         for message in self.conversation[convo_id]:
-            # every message follows <im_start>{role/name}\n{content}<im_end>\n
-            num_tokens += 5
-            for key, value in message.items():
-                num_tokens += len(encoding.encode(value))
-                if key == "name":  # if there's a name, the role is omitted
-                    num_tokens += 5  # role is always required and always 1 token
+            num_tokens += message.token_count(encoding)
         num_tokens += 5  # every reply is primed with <im_start>assistant
         return num_tokens
 
-    def get_max_tokens(self, convo_id: str) -> int:
+    def get_max_tokens(self, convo_id: str, engine: str = None) -> int:
         """
         Get max tokens
         """
-        return self.max_tokens - self.get_token_count(convo_id)
+        max_tokens = self.get_limits(engine or self.engine)[0]
+        return max_tokens - self.get_token_count(convo_id)
 
-    def ask_stream(
+    def get_request_body(
         self,
-        prompt: str,
         role: str = "user",
         convo_id: str = "default",
+        engine: str = None,
         **kwargs,
-    ):
+    ) -> bytes:
         """
-        Ask a question
+        Build request body from cached message fragments
         """
-        # Make conversation if it doesn't exist
-        if convo_id not in self.conversation:
-            self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
-        self.add_to_conversation(prompt, "user", convo_id=convo_id)
-        self.__truncate_conversation(convo_id=convo_id)
-        # Get response
-        response = self.session.post(
-            os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
-                "model": self.engine,
-                "messages": self.conversation[convo_id],
+        engine = engine or self.engine
+        body = json.dumps(
+            {
+                "model": engine,
                 "stream": True,
                 # kwargs
                 "temperature": kwargs.get("temperature", self.temperature),
@@ -178,8 +410,61 @@ class Chatbot:
                 ),
                 "n": kwargs.get("n", self.reply_count),
                 "user": role,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
+                "max_tokens": self.get_max_tokens(convo_id=convo_id, engine=engine),
+            }
+        ).encode("utf-8")
+        messages = b",".join(
+            message.fragment() for message in self.conversation[convo_id]
+        )
+        # splice messages into the closing brace of the json object
+        return body[:-1] + b', "messages": [' + messages + b"]}"
+
+    def dump_conversation(self) -> dict:
+        """
+        Dump all conversations as plain dicts
+        """
+        return {
+            convo_id: [message.to_dict() for message in messages]
+            for convo_id, messages in self.conversation.items()
+        }
+
+    def load_conversation(self, conversation: dict) -> None:
+        """
+        Load conversations dumped by dump_conversation
+        """
+        for convo_id, messages in conversation.items():
+            self.conversation[convo_id] = [
+                Message(message["role"], message["content"]) for message in messages
+            ]
+
+    def ask_stream(
+        self,
+        prompt: str,
+        role: str = "user",
+        convo_id: str = "default",
+        **kwargs,
+    ):
+        """
+        Ask a question
+        """
+        # Make conversation if it doesn't exist
+        if convo_id not in self.conversation:
+            self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
+        self.add_to_conversation(prompt, "user", convo_id=convo_id)
+        self.__truncate_conversation(convo_id=convo_id)
+        engine = kwargs.pop("engine", None) or self.select_engine(
+            self.get_token_count(convo_id)
+        )
+        # Get response
+        response = self.session.post(
+            self.endpoints.choose(),
+            headers={
+                "Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}",
+                "Content-Type": "application/json",
             },
+            data=self.get_request_body(
+                role=role, convo_id=convo_id, engine=engine, **kwargs
+            ),
             timeout=kwargs.get("timeout", self.timeout),
             stream=True,
         )
@@ -223,60 +508,99 @@ class Chatbot:
             self.reset(convo_id=convo_id, system_prompt=self.system_prompt)
         self.add_to_conversation(prompt, "user", convo_id=convo_id)
         self.__truncate_conversation(convo_id=convo_id)
-        # Get response
-        async with self.aclient.stream(
-            "post",
-            os.environ.get("API_URL") or "https://api.openai.com/v1/chat/completions",
-            headers={"Authorization": f"Bearer {kwargs.get('api_key', self.api_key)}"},
-            json={
-                "model": self.engine,
-                "messages": self.conversation[convo_id],
-                "stream": True,
-                # kwargs
-                "temperature": kwargs.get("temperature", self.temperature),
-                "top_p": kwargs.get("top_p", self.top_p),
-                "presence_penalty": kwargs.get(
-                    "presence_penalty",
-                    self.presence_penalty,
-                ),
-                "frequency_penalty": kwargs.get(
-                    "frequency_penalty",
-                    self.frequency_penalty,
-                ),
-                "n": kwargs.get("n", self.reply_count),
-                "user": role,
-                "max_tokens": self.get_max_tokens(convo_id=convo_id),
-            },
-            timeout=kwargs.get("timeout", self.timeout),
-        ) as response:
-            if response.status_code != 200:
-                await response.aread()
-
-            response_role: str = ""
-            full_response: str = ""
-            async for line in response.aiter_lines():
-                line = line.strip()
-                if not line:
-                    continue
-                # Remove "data: "
-                line = line[6:]
-                if line == "[DONE]":
-                    break
-                resp: dict = json.loads(line)
-                choices = resp.get("choices")
-                if not choices:
-                    continue
-                delta: dict[str, str] = choices[0].get("delta")
-                if not delta:
-                    continue
-                if "role" in delta:
-                    response_role = delta["role"]
-                if "content" in delta:
-                    content: str = delta["content"]
+        engine = kwargs.pop("engine", None) or self.select_engine(
+            self.get_token_count(convo_id)
+        )
+        body = self.get_request_body(
+            role=role, convo_id=convo_id, engine=engine, **kwargs
+        )
+
+        async def attempt(endpoint: str) -> tuple:
+            # least loaded api key, held until the stream is closed
+            api_key = await self.key_pool.get()
+            try:
+                # open stream and wait for the first delta
+                key = kwargs.get("api_key", api_key.key)
+                request = self.aclient.build_request(
+                    "post",
+                    endpoint,
+                    headers={
+                        "Authorization": f"Bearer {key}",
+                        "Content-Type": "application/json",
+                    },
+                    content=body,
+                    timeout=kwargs.get("timeout", self.timeout),
+                )
+                response = await self.aclient.send(request, stream=True)
+            except BaseException:
+                await self.key_pool.release(api_key)
+                raise
+            try:
+                self.key_pool.update(
+                    api_key, response.status_code, response.headers
+                )
+                if response.status_code != 200:
+                    await response.aread()
+                    raise status_error(response.status_code, response.text)
+                deltas = self.__iter_deltas(response)
+                first = await deltas.__anext__()
+            except StopAsyncIteration:
+                first = None
+            except BaseException:
+                await response.aclose()
+                await self.key_pool.release(api_key)
+                raise
+            return response, deltas, first, api_key
+
+        async def discard(result: tuple) -> None:
+            await result[0].aclose()
+            await self.key_pool.release(result[3])
+
+        # Get response, hedged across endpoints on slow first token
+        start = time.monotonic()
+        response, deltas, first, api_key = await self.endpoints.request(
+            attempt, discard=discard
+        )
+        self.record_latency(engine, time.monotonic() - start)
+        response_role: str = ""
+        full_response: str = ""
+        try:
+            while first is not None:
+                if "role" in first:
+                    response_role = first["role"]
+                if "content" in first:
+                    content: str = first["content"]
                     full_response += content
                     yield content
+                first = await deltas.__anext__()
+        except StopAsyncIteration:
+            pass
+        finally:
+            await response.aclose()
+            await self.key_pool.release(api_key)
         self.add_to_conversation(full_response, response_role, convo_id=convo_id)
 
+    async def __iter_deltas(self, response) -> AsyncGenerator[dict, None]:
+        """
+        Parse server-sent events into deltas
+        """
+        async for line in response.aiter_lines():
+            line = line.strip()
+            if not line:
+                continue
+            # Remove "data: "
+            line = line[6:]
+            if line == "[DONE]":
+                break
+            resp: dict = json.loads(line)
+            choices = resp.get("choices")
+            if not choices:
+                continue
+            delta: dict[str, str] = choices[0].get("delta")
+            if not delta:
+                continue
+            yield delta
+
     async def ask_async(
         self,
         prompt: str,
@@ -315,10 +639,18 @@ class Chatbot:
         full_response: str = "".join(response)
         return full_response
 
+    async def close(self) -> None:
+        """
+        Close http clients
+        """
+        self.session.close()
+        if hasattr(self, "aclient"):
+            await self.aclient.aclose()
+
     def reset(self, convo_id: str = "default", system_prompt: str = None) -> None:
         """
         Reset the conversation
         """
         self.conversation[convo_id] = [
-            {"role": "system", "content": system_prompt or self.system_prompt},
+            Message("system", system_prompt or self.system_prompt),
         ]
@@ -0,0 +1,178 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import zlib
+from typing import Optional
+from bot import Bot, create_driver
+from config import ConfigWatcher
+from shard import ShardRouter
+from log import getlogger
+
+logger = getlogger()
+
+
+# hard link blobs so seeding a worker cache costs no disk space
+def link_or_copy(src: str, dst: str) -> None:
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+# files written by each worker get their own path
+def worker_config(index: int, config: dict) -> dict:
+    config = dict(config)
+    state_path = config["state_path"] or "state.json"
+    image_cache_path = config["image_cache_path"] or "images/cache"
+    config["state_path"] = f"{state_path}.{index}"
+    config["image_cache_path"] = f"{image_cache_path}.{index}"
+    if config["similarity_cache_path"]:
+        config["similarity_cache_path"] = f"{config['similarity_cache_path']}.{index}"
+    # the ingestor holds the shard lock and drops channels of other replicas
+    config.update(replica_index=0, replica_count=1, shard_dir=None)
+    return config
+
+
+# start from caches warmed by batch.py or a single process run
+def seed_caches(config: dict, own: dict) -> None:
+    base = config["image_cache_path"] or "images/cache"
+    if os.path.isdir(base) and not os.path.exists(own["image_cache_path"]):
+        shutil.copytree(base, own["image_cache_path"], copy_function=link_or_copy)
+    base = config["similarity_cache_path"]
+    if base and os.path.exists(base):
+        if not os.path.exists(own["similarity_cache_path"]):
+            shutil.copyfile(base, own["similarity_cache_path"])
+
+
+# worker process entry, runs its own event loop and backend clients
+def worker_main(index: int, config: dict, queue) -> None:
+    # ctrl-c and SIGHUP reach the whole process group, the ingestor stops
+    # workers in order and forwards reloads
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, config, queue))
+
+
+async def serve_worker(index: int, config: dict, queue) -> None:
+    own = worker_config(index, config)
+    seed_caches(config, own)
+    mattermost_bot = Bot(**own)
+    mattermost_bot.login()
+
+    async def reload(new_config: dict) -> None:
+        await mattermost_bot.reload(worker_config(index, new_config))
+
+    watcher = ConfigWatcher("config.json", reload)
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, watcher.trigger)
+    watch_task = asyncio.create_task(watcher.watch())
+    logger.info(f"worker {index} started")
+    try:
+        await mattermost_bot.serve(queue)
+    finally:
+        watch_task.cancel()
+        await mattermost_bot.shutdown()
+        logger.info(f"worker {index} stopped")
+
+
+class Ingestor:
+    """
+    Own the websocket and hand events to worker processes
+    Parameters:
+        config: dict, Bot config passed to every worker
+        workers: int, number of worker processes
+    """
+
+    def __init__(self, config: dict, workers: int) -> None:
+        self.config = config
+        self.shard = ShardRouter(
+            replica_index=int(config["replica_index"] or 0),
+            replica_count=int(config["replica_count"] or 1),
+            shard_dir=config["shard_dir"],
+        )
+        self.driver = create_driver(
+            config["server_url"],
+            config["access_token"],
+            config["login_id"],
+            config["password"],
+            config["port"],
+            config["timeout"],
+        )
+        # spawn avoids forking a process with a running event loop
+        context = multiprocessing.get_context("spawn")
+        self.queues = [context.Queue() for _ in range(workers)]
+        self.processes = [
+            context.Process(
+                target=worker_main,
+                args=(index, config, queue),
+                name=f"worker-{index}",
+            )
+            for index, queue in enumerate(self.queues)
+        ]
+
+    async def start(self) -> None:
+        await self.shard.start()
+        for process in self.processes:
+            process.start()
+        self.driver.login()
+
+    # ask workers to reload config, used as SIGHUP handler
+    def reload(self) -> None:
+        for process in self.processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGHUP)
+
+    # crc32 is stable across processes, conversation context stays in one worker
+    def route(self, channel_id: str) -> int:
+        return zlib.crc32(channel_id.encode()) % len(self.queues)
+
+    def channel_of(self, response: dict) -> Optional[str]:
+        data = response.get("data", {})
+        if "post" in data:
+            return json.loads(data["post"])["channel_id"]
+        return response.get("broadcast", {}).get("channel_id") or None
+
+    async def websocket_handler(self, message) -> None:
+        response = json.loads(message)
+        if "event" not in response:
+            return
+        channel_id = self.channel_of(response)
+        # channel belongs to another replica
+        if (
+            response["event"] == "posted"
+            and channel_id is not None
+            and not self.shard.owns(channel_id)
+        ):
+            return
+        if channel_id is None:
+            # user and channel metadata updates are needed by every worker
+            for queue in self.queues:
+                queue.put(message)
+        else:
+            self.queues[self.route(channel_id)].put(message)
+
+    async def run(self) -> None:
+        await self.driver.init_websocket(self.websocket_handler)
+
+    # workers drain their requests before exiting
+    async def shutdown(self) -> None:
+        # hand channels over to live replicas while draining
+        self.shard.stop()
+        for queue in self.queues:
+            queue.put(None)
+        # Bot.shutdown drains the scheduler and then background tasks, each
+        # within shutdown_timeout, plus time to save state and close sessions
+        timeout = 2 * float(self.config["shutdown_timeout"] or 30) + 10
+        for process in self.processes:
+            await asyncio.to_thread(process.join, timeout)
+            if process.is_alive():
+                # workers ignore SIGTERM, see worker_main
+                logger.warning(f"{process.name} did not stop in time, killing")
+                process.kill()
+                await asyncio.to_thread(process.join)
+        # stopped before run() opened the websocket
+        if self.driver.websocket is not None:
+            self.driver.disconnect()